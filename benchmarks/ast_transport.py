@@ -0,0 +1,49 @@
+"""Benchmark of sending parsed ASTs of a 2000 line submission to a worker.
+
+Compares the pickles of annotated nodes, as sent before, with the stripped
+nodes ``Channel`` sends now, for the whole module and for a focused function::
+
+    python benchmarks/ast_transport.py
+"""
+import pickle
+import timeit
+from multiprocessing.reduction import ForkingPickler
+
+from tcs_pythonwhat.local import ChannelPickler
+from tcs_pythonwhat.State import Dispatcher
+
+FUNCTION = '''
+def function_{0}(values, factor={0}):
+    """Scale and sum the values."""
+    result = []
+    for value in values:
+        if value > {0}:
+            result.append(value * factor)
+        else:
+            result.append(value - factor)
+    return sum(result)
+'''
+
+CODE = "".join(FUNCTION.format(i) for i in range(200))
+
+
+def bench(pickler, tree, number=20):
+    size = len(pickler.dumps(tree, 5))
+    seconds = min(
+        timeit.repeat(
+            lambda: pickle.loads(pickler.dumps(tree, 5)), number=number, repeat=5
+        )
+    )
+    return size, seconds / number * 1e3
+
+
+if __name__ == "__main__":
+    _, tree = Dispatcher().parse(CODE)
+    print("%d lines" % len(CODE.splitlines()))
+    for name, node in [("module", tree), ("function", tree.body[100])]:
+        for pickler in [ForkingPickler, ChannelPickler]:
+            size, milliseconds = bench(pickler, node)
+            print(
+                "%-10s %-15s %9d bytes %8.2f ms per dump and load"
+                % (name, pickler.__name__, size, milliseconds)
+            )
@@ -0,0 +1,53 @@
+"""Benchmark of a deep chain of child states for growing pre exercise code.
+
+Every state of a chain gets a dispatcher for the pre exercise code. With the
+content addressed ``ContextCache`` the code is parsed once, without it (as
+before) it's parsed again for every child state::
+
+    python benchmarks/context_cache.py
+"""
+import timeit
+
+from tcs_protowhat.Reporter import Reporter
+from tcs_pythonwhat.State import ContextCache, Dispatcher, State
+
+PEC_LINE = "import module_{0} as m{0}\ndef function_{0}(x):\n    return m{0}.f(x)\n"
+
+CODE = "for i in range(3):\n    print(round(i, 2))\n"
+
+DEPTH = 50
+
+
+def chain(pec):
+    state = State(
+        student_code=CODE,
+        solution_code=CODE,
+        pre_exercise_code=pec,
+        student_process=None,
+        solution_process=None,
+        raw_student_output="",
+        reporter=Reporter(),
+    )
+    for _ in range(DEPTH):
+        state = state.to_child(
+            student_ast=state.student_ast, solution_ast=state.solution_ast
+        )
+
+
+def bench(pec, cache, number=5):
+    Dispatcher._context_cache = cache
+    seconds = min(timeit.repeat(lambda: chain(pec), number=number, repeat=3))
+    return seconds / number * 1e3
+
+
+if __name__ == "__main__":
+    for lines in [0, 100, 1000]:
+        pec = "".join(PEC_LINE.format(i) for i in range(lines // 3))
+        for name, cache in [
+            ("uncached", ContextCache(max_size=0)),
+            ("cached", ContextCache()),
+        ]:
+            print(
+                "%5d PEC lines %-9s %8.2f ms per chain of %d states"
+                % (lines, name, bench(pec, cache), DEPTH + 1)
+            )
@@ -0,0 +1,67 @@
+"""Micro-benchmark of task round trips between the grading process and a worker.
+
+Compares the transport of ``WorkerProcess`` with the transport it replaced,
+a task queue and a result queue::
+
+    python benchmarks/rpc_roundtrip.py
+"""
+import timeit
+from functools import partial
+from multiprocessing import Queue
+
+from tcs_pythonwhat.local import SimpleProcess, StubShell, TaskCaptureOutput, serve
+from tcs_pythonwhat.tasks import isDefinedInProcess
+
+
+class QueueProcess(SimpleProcess):
+    """Worker process reached over a task queue and a result queue."""
+
+    def __init__(self):
+        SimpleProcess.__init__(self)
+        self.task_queue = Queue()
+        self.result_queue = Queue()
+
+    def run(self):
+        serve(StubShell(), self.task_queue.get, self.result_queue.put_nowait)
+
+    def executeTask(self, task):
+        self.task_queue.put_nowait(task)
+        return self.result_queue.get()
+
+
+class TaskEcho:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __call__(self, shell):
+        return self.payload
+
+
+TASKS = {
+    "isDefinedInProcess": partial(isDefinedInProcess, "x", None),
+    "echo 1 MiB": TaskEcho(b"x" * 2 ** 20),
+}
+
+
+def bench(process_class, task, number):
+    process = process_class()
+    process.start()
+    process.executeTask(TaskCaptureOutput("x = 1"))
+    try:
+        seconds = min(
+            timeit.repeat(lambda: process.executeTask(task), number=number, repeat=5)
+        )
+    finally:
+        process.kill()
+    return seconds / number * 1e6
+
+
+if __name__ == "__main__":
+    for name, task in TASKS.items():
+        number = 2000 if name == "isDefinedInProcess" else 200
+        for process_class in [QueueProcess, SimpleProcess]:
+            microseconds = bench(process_class, task, number)
+            print(
+                "%-20s %-15s %8.1f us per round trip"
+                % (name, process_class.__name__, microseconds)
+            )
@@ -0,0 +1,51 @@
+"""Benchmark of finding all parser outputs for a 2000 line submission.
+
+Compares running every parser over the whole module, as before, with the
+dispatcher running them over the statements ``StatementFilter`` selects::
+
+    python benchmarks/statement_filter.py
+"""
+import timeit
+
+from tcs_pythonwhat.State import Dispatcher
+from tcs_pythonwhat.parsing import FunctionParser, ObjectAccessParser, parser_dict
+
+BLOCK = """
+x_{0} = [{0}, 2, 3]
+x_{0}.append(len(x_{0}))
+print(sum(x_{0}), max(x_{0}))
+if x_{0}[0] > 1:
+    y_{0} = [i * 2 for i in x_{0}]
+for i in x_{0}:
+    print(round(i / 3, 2))
+def function_{0}(a, b={0}):
+    return a + b
+"""
+
+CODE = "".join(BLOCK.format(i) for i in range(200))
+
+
+def visit_all(dispatcher, tree):
+    for Parser in parser_dict.values():
+        parser = Parser()
+        if Parser in [FunctionParser, ObjectAccessParser]:
+            parser.mappings = dispatcher.context_mappings.copy()
+        parser.visit(tree)
+
+
+def find_all(tree):
+    dispatcher = Dispatcher()
+    for name in parser_dict:
+        dispatcher.find(name, tree)
+
+
+if __name__ == "__main__":
+    dispatcher = Dispatcher()
+    _, tree = dispatcher.parse(CODE)
+    print("%d lines, %d parsers" % (len(CODE.splitlines()), len(parser_dict)))
+    for name, run in [
+        ("visit", lambda: visit_all(dispatcher, tree)),
+        ("filtered", lambda: find_all(tree)),
+    ]:
+        seconds = min(timeit.repeat(run, number=10, repeat=5))
+        print("%-8s %8.2f ms for all outputs" % (name, seconds / 10 * 1e3))
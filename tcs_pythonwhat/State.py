@@ -1,6 +1,13 @@
+import ast
+import sys
+import hashlib
 import asttokens
 
-from functools import partialmethod
+from threading import Lock
+from contextvars import ContextVar
+from weakref import WeakKeyDictionary
+from functools import partial, partialmethod
+from collections import OrderedDict
 from collections.abc import Mapping
 
 from tcs_protowhat.failure import debugger
@@ -11,10 +18,13 @@ from tcs_protowhat.utils import parameters_attr
 from tcs_pythonwhat import signatures
 from tcs_pythonwhat.converters import get_manual_converters
 from tcs_pythonwhat.feedback import Feedback
+from tcs_pythonwhat.tasks import getSignatureInProcess
 from tcs_pythonwhat.parsing import (
     TargetVars,
     FunctionParser,
+    StatementFilter,
     ObjectAccessParser,
+    Parser as BaseParser,
     parser_dict,
 )
 from tcs_pythonwhat.utils_ast import wrap_in_module
@@ -40,8 +50,22 @@ class Context(Mapping):
         return len(self._items)
 
 
+class StateType(type):
+    """Keeps ``State.root_state`` per context, so SCTs of different gradings can run in parallel."""
+
+    _root_state = ContextVar("root_state", default=None)
+
+    @property
+    def root_state(cls):
+        return cls._root_state.get()
+
+    @root_state.setter
+    def root_state(cls, state):
+        cls._root_state.set(state)
+
+
 @parameters_attr
-class State(ProtoState):
+class State(ProtoState, metaclass=StateType):
     """State of the SCT environment.
 
     This class holds all information relevevant to test the correctness of an exercise.
@@ -82,6 +106,7 @@ class State(ProtoState):
         solution_context=Context(),
         student_env=Context(),
         solution_env=Context(),
+        ast_dispatcher=None,
     ):
         args = locals().copy()
         self.debug = False
@@ -90,7 +115,9 @@ class State(ProtoState):
             if k != "self":
                 setattr(self, k, v)
 
-        self.ast_dispatcher = self.get_dispatcher()
+        # child states share the dispatcher of the root state, and so its parser outputs
+        if ast_dispatcher is None:
+            self.ast_dispatcher = self.get_dispatcher()
 
         # Parse solution and student code
         # if possible, not done yet and wanted (ast arguments not False)
@@ -106,6 +133,13 @@ class State(ProtoState):
         self.converters = get_manual_converters()  # accessed only from root state
 
         self.manual_sigs = None
+        # resolved signatures, shared by all states of a grading
+        self.signature_cache = {}
+        # solution results shared by gradings, set on the root state by run_sct
+        self.result_cache = None
+        self.exercise_key = None
+        # code and location ``run`` executed the solution process with, None for the root process
+        self.solution_setup = None
 
     def get_manual_sigs(self):
         if self.manual_sigs is None:
@@ -113,6 +147,69 @@ class State(ProtoState):
 
         return self.manual_sigs
 
+    def get_solution_result(self, compute, *key_parts):
+        """Get a result of the solution side of a check from ``result_cache``.
+
+        If it isn't cached yet, ``compute`` is called and its result stored.
+        The key parts describe the check step; results are kept per exercise
+        and per solution process, which ``run`` can replace.
+        """
+        if self.result_cache is None:
+            return compute()
+        key = self.result_cache.get_key(
+            self.exercise_key, self.solution_setup, *key_parts
+        )
+        if key is None:
+            return compute()
+        result = self.result_cache.get(key)
+        if result is None:
+            result = compute()
+            self.result_cache.put(key, result)
+        return result
+
+    def get_signature(self, name, mapped_name, signature, process):
+        """Get the signature of a function call in a process.
+
+        Unless ``manual_sigs`` were set on the state, the process uses the manual
+        signatures it holds itself and the signature is cached for the rest of the grading.
+        Signatures in the solution process are kept in ``result_cache`` as well.
+        """
+        if self.manual_sigs is not None:
+            return getSignatureInProcess(
+                name=name,
+                mapped_name=mapped_name,
+                signature=signature,
+                manual_sigs=self.manual_sigs,
+                process=process,
+            )
+
+        key = (process, name, mapped_name, signature)
+        try:
+            return self.signature_cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # e.g. a signature with unhashable defaults
+            key = None
+
+        get_sig = partial(
+            getSignatureInProcess,
+            name=name,
+            mapped_name=mapped_name,
+            signature=signature,
+            manual_sigs=None,
+            process=process,
+        )
+        if process is self.solution_process:
+            sig = self.get_solution_result(
+                get_sig, "signature", self.solution_code, name, mapped_name, signature
+            )
+        else:
+            sig = get_sig()
+        if key is not None:
+            self.signature_cache[key] = sig
+        return sig
+
     def to_child(self, append_message=None, node_name="", **kwargs):
         """Dive into nested tree.
 
@@ -129,7 +226,7 @@ class State(ProtoState):
         base_kwargs = {
             attr: getattr(self, attr)
             for attr in self.parameters
-            if hasattr(self, attr) and attr not in ["ast_dispatcher", "highlight"]
+            if hasattr(self, attr) and attr != "highlight"
         }
 
         if append_message and not isinstance(append_message, FeedbackComponent):
@@ -176,7 +273,7 @@ class State(ProtoState):
         for attr in extra_attrs:
             # don't copy attrs set on new instances in init
             # the cached manual_sigs is passed
-            if attr not in {"ast_dispatcher", "converters"}:
+            if attr != "converters":
                 setattr(child, attr, getattr(self, attr))
 
         return child
@@ -246,7 +343,7 @@ class State(ProtoState):
 
     def parse_internal(self, code):
         try:
-            return self.ast_dispatcher.parse(code)
+            return self.ast_dispatcher.parse_solution(code)
         except Exception as e:
             self.report(
                 "Что-то пошло не так при парсинге solution-кода: %s" % str(e)
@@ -273,17 +370,148 @@ class State(ProtoState):
                 self.report("Что-то пошло не так при парсинге PEC: %s" % str(e))
 
 
+class ContextCache:
+    """Cache of the function mappings of pre exercise code, keyed by a digest of the code.
+
+    Every state gets a dispatcher for the pre exercise code, so without the cache,
+    the code would be parsed again for every check in a chain.
+    The mappings are shared by the dispatchers and must not be changed.
+    The least recently used mappings are dropped when more than ``max_size`` are kept
+    or they take more than ``max_memory`` bytes.
+    """
+
+    def __init__(self, max_size=256, max_memory=16 * 2 ** 20):
+        self.max_size = max_size
+        self.max_memory = max_memory
+        self._mappings = OrderedDict()  # digest -> (mappings, size), least recently used first
+        self._memory = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._mappings)
+
+    def get_mappings(self, context_code, compute):
+        """Get the mappings of the code, calling ``compute`` with the code if they aren't cached."""
+        key = hashlib.sha256(context_code.encode()).digest()
+        with self._lock:
+            entry = self._mappings.get(key)
+            if entry is not None:
+                self._mappings.move_to_end(key)
+                return entry[0]
+        # parse outside of the lock, other threads may have to wait on it otherwise
+        mappings = compute(context_code)
+        size = sys.getsizeof(mappings) + sum(
+            sys.getsizeof(name) + sys.getsizeof(target)
+            for name, target in mappings.items()
+        )
+        with self._lock:
+            previous = self._mappings.pop(key, None)
+            if previous is not None:
+                self._memory -= previous[1]
+            self._mappings[key] = (mappings, size)
+            self._memory += size
+            while self._mappings and (
+                len(self._mappings) > self.max_size or self._memory > self.max_memory
+            ):
+                _, (_, evicted) = self._mappings.popitem(last=False)
+                self._memory -= evicted
+        return mappings
+
+    def clear(self):
+        with self._lock:
+            self._mappings.clear()
+            self._memory = 0
+
+
+class ParsedSolution:
+    """Solution code parsed by ``SolutionParseCache``, shared by gradings.
+
+    The tokens, tree and parser outputs are only read by checks.
+    """
+
+    def __init__(self, tokens, tree):
+        self.tokens = tokens
+        self.tree = tree
+        self.nodes = frozenset(ast.walk(tree))
+        self.parser_cache = {}  # node -> {parser name: parser}, as in Dispatcher
+
+    def get_parsers(self, node):
+        """Parsers run over a node of the solution so far, or ``None`` for other nodes."""
+        if node not in self.nodes:
+            return None
+        return self.parser_cache.setdefault(node, {})
+
+
+class SolutionParseCache:
+    """Process-wide cache of parsed solution code, keyed by a digest of the solution and pre exercise code.
+
+    For a given exercise, the solution code is the same for every submission,
+    so gradings reuse its tokens, tree and the parser outputs for it,
+    see ``Dispatcher.parse_solution``.
+    The least recently parsed solutions are dropped when more than ``max_size`` are kept.
+    Use ``invalidate`` to drop the solution of an exercise, e.g. after changing it.
+    """
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self._solutions = OrderedDict()  # digest -> ParsedSolution, least recently used first
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._solutions)
+
+    @staticmethod
+    def get_key(solution_code, pre_exercise_code):
+        content = "\0".join([pre_exercise_code or "", solution_code])
+        return hashlib.sha256(content.encode()).digest()
+
+    def get(self, solution_code, pre_exercise_code, parse):
+        """Get the parsed solution, calling ``parse`` with the code if it isn't cached."""
+        key = self.get_key(solution_code, pre_exercise_code)
+        with self._lock:
+            solution = self._solutions.get(key)
+            if solution is not None:
+                self._solutions.move_to_end(key)
+                return solution
+        # parse outside of the lock, parsing errors aren't cached
+        solution = ParsedSolution(*parse(solution_code))
+        with self._lock:
+            solution = self._solutions.setdefault(key, solution)
+            self._solutions.move_to_end(key)
+            while len(self._solutions) > self.max_size:
+                self._solutions.popitem(last=False)
+        return solution
+
+    def invalidate(self, solution_code, pre_exercise_code=""):
+        """Drop the parsed solution of an exercise."""
+        with self._lock:
+            self._solutions.pop(self.get_key(solution_code, pre_exercise_code), None)
+
+    def clear(self):
+        with self._lock:
+            self._solutions.clear()
+
+
 class Dispatcher(DispatcherInterface):
-    _context_cache = dict()
+    _context_cache = ContextCache()
+    solution_cache = SolutionParseCache()
 
     def __init__(self, context_code=""):
-        self._parser_cache = dict()
-        context_ast = getattr(self._context_cache, context_code, None)
-        if context_ast is None:
-            context_ast = self._context_cache[context_code] = self.parse(context_code)[
-                1
-            ]
-        self.context_mappings = self._getx(FunctionParser, "mappings", context_ast)
+        self.context_code = context_code
+        # node -> {parser name: parser}, entries are dropped with the node
+        self._parser_cache = WeakKeyDictionary()
+        # solution code parsed by solution_cache, if any
+        self.solution = None
+        # module -> StatementFilter, shared by the parsers of the module
+        self._statement_filters = WeakKeyDictionary()
+        self.context_mappings = self._context_cache.get_mappings(
+            context_code, self.get_context_mappings
+        )
+
+    def get_context_mappings(self, context_code):
+        p = FunctionParser()
+        p.visit(self.parse(context_code)[1])
+        return p.mappings
 
     def find(self, name, node, *args, **kwargs):
         return getattr(self, name)(node)
@@ -292,14 +520,30 @@ class Dispatcher(DispatcherInterface):
         res = asttokens.ASTTokens(code, parse=True)
         return res, res.tree
 
+    def parse_solution(self, code):
+        """Parse solution code through ``solution_cache``, sharing its parser outputs with other gradings."""
+        self.solution = self.solution_cache.get(code, self.context_code, self.parse)
+        return self.solution.tokens, self.solution.tree
+
     # add methods for retrieving parser outputs --------------------------
+    def get_parsers(self, tree):
+        """Parsers run over a tree so far, by name."""
+        if self.solution is not None:
+            parsers = self.solution.get_parsers(tree)
+            if parsers is not None:
+                return parsers
+        return self._parser_cache.setdefault(tree, {})
+
     def _getx(self, Parser, ext_attr, tree):
         """getter for Parser outputs"""
         # return cached output if possible
-        cache_key = Parser.__name__ + str(hash(tree))
-        if self._parser_cache.get(cache_key):
-            p = self._parser_cache[cache_key]
-        else:
+        try:
+            parsers = self.get_parsers(tree)
+        except TypeError:
+            # e.g. no tree, as the code couldn't be parsed
+            parsers = {}
+        p = parsers.get(Parser.__name__)
+        if p is None:
             # otherwise, run parser over tree
             p = Parser()
             # set mappings for parsers that inspect attribute access
@@ -309,12 +553,25 @@ class Dispatcher(DispatcherInterface):
             ]:
                 p.mappings = self.context_mappings.copy()
             # run parser
-            p.visit(tree)
+            self.run_parser(p, tree)
             # cache
-            self._parser_cache[cache_key] = p
+            parsers[Parser.__name__] = p
         return getattr(p, ext_attr)
 
 
+    def run_parser(self, parser, tree):
+        """Run a parser over a tree, visiting modules through their ``StatementFilter``."""
+        if not (
+            isinstance(tree, ast.Module)
+            and type(parser).visit_Module is BaseParser.visit_Module
+        ):
+            return parser.visit(tree)
+        statements = self._statement_filters.get(tree)
+        if statements is None:
+            statements = self._statement_filters[tree] = StatementFilter(tree)
+        statements.visit(parser)
+
+
 # put a function on the dispatcher
 for k, Parser in parser_dict.items():
     setattr(Dispatcher, k, partialmethod(Dispatcher._getx, Parser, "out"))
@@ -87,17 +87,22 @@ class EqualTest(Test):
         result (bool): True if the test succeed, False if it failed. None if it hasn't been tested yet.
     """
 
-    def __init__(self, obj1, obj2, feedback, func=None):
+    def __init__(self, obj1, obj2, feedback, func=None, release=None):
         super().__init__(feedback)
         self.obj1 = obj1
         self.obj2 = obj2
         self.func = func if func is not None else is_equal
+        self.release = release
 
     def test(self):
         """
         Perform the actual test. result is set to False if the objects differ, True otherwise.
+        If a release function was given, the objects are dropped and the function is called afterwards.
         """
         self.result = np.array(self.func(self.obj1, self.obj2)).all()
+        if self.release is not None:
+            self.obj1 = self.obj2 = None
+            self.release()
 
 
 # Helpers for testing equality
@@ -1,9 +1,9 @@
 from tcs_protowhat.Feedback import FeedbackComponent
 from tcs_pythonwhat.checks.check_funcs import part_to_child
-from tcs_pythonwhat.tasks import getSignatureInProcess
 from tcs_protowhat.utils_messaging import get_ord, get_times
 from tcs_protowhat.failure import debugger
 from tcs_pythonwhat.parsing import IndexedDict
+from tcs_pythonwhat.tasks import dispatch
 from functools import partial
 
 
@@ -36,6 +36,13 @@ SIG_ISSUE_MSG = (
 PREPEND_MSG = "Проверьте {{ord + ' ' if index>0}} вызов `{{mapped_name}}()`. "
 
 
+def get_signature_or_error(get_signature, **kwargs):
+    try:
+        return get_signature(**kwargs)
+    except Exception as e:
+        return e
+
+
 def check_function(
     state,
     name,
@@ -136,16 +143,19 @@ def check_function(
     if signature:
         signature = None if isinstance(signature, bool) else signature
         get_sig = partial(
-            getSignatureInProcess,
-            name=name,
-            signature=signature,
-            manual_sigs=state.get_manual_sigs(),
+            get_signature_or_error, state.get_signature, name=name, signature=signature
+        )
+        # look up both signatures at the same time
+        sol_sig, stu_sig = dispatch(
+            partial(get_sig, mapped_name=sol_parts["name"], process=state.solution_process),
+            partial(get_sig, mapped_name=stu_parts["name"], process=state.student_process),
+            state.solution_process,
+            state.student_process,
         )
 
         try:
-            sol_sig = get_sig(
-                mapped_name=sol_parts["name"], process=state.solution_process
-            )
+            if isinstance(sol_sig, Exception):
+                raise sol_sig
             sol_parts["args"] = bind_args(sol_sig, sol_parts["args"])
         except Exception as e:
             with debugger(state):
@@ -155,9 +165,8 @@ def check_function(
                 )
 
         try:
-            stu_sig = get_sig(
-                mapped_name=stu_parts["name"], process=state.student_process
-            )
+            if isinstance(stu_sig, Exception):
+                raise stu_sig
             stu_parts["args"] = bind_args(stu_sig, stu_parts["args"])
         except Exception:
             state.to_child(highlight=stu_parts["node"]).report(
@@ -201,6 +201,9 @@ def set_context(state, *args, **kwargs):
             Ex().check_for_loop().check_body().\\
                 multi([s.has_equal_output(context_vals=[i]) for i in range(1, 4)])
 
+            # equivalent SCT, evaluating all cases in a single round trip
+            Ex().check_for_loop().check_body().has_equal_output(context_cases=[[1], [2], [3]])
+
     """
 
     stu_crnt = state.student_context.context
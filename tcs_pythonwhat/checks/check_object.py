@@ -168,7 +168,12 @@ def check_object(state, index, missing_msg=None, expand_msg=None, typestr="пе
         expand_msg = "Вы правильно определили {{typestr}} `{{index}}`? "
 
     if (
-        not isDefinedInProcess(index, state.solution_process)
+        not state.get_solution_result(
+            lambda: isDefinedInProcess(index, state.solution_process),
+            "is_defined",
+            state.solution_code,
+            index,
+        )
         and state.has_different_processes()
     ):
         raise InstructorError.from_message(
@@ -237,7 +242,13 @@ def is_instance(state, inst, not_instance_msg=None):
     if not_instance_msg is None:
         not_instance_msg = "Это {{inst.__name__}}?"
 
-    if not isInstanceInProcess(sol_name, inst, state.solution_process):
+    if not state.get_solution_result(
+        lambda: isInstanceInProcess(sol_name, inst, state.solution_process),
+        "is_instance",
+        state.solution_code,
+        sol_name,
+        inst,
+    ):
         raise InstructorError.from_message(
             "`is_instance()` выявило, что `%s` не является `%s` в solution-коде."
             % (sol_name, inst.__name__)
@@ -339,7 +350,13 @@ def check_keys(state, key, missing_msg=None, expand_msg=None):
     sol_name = state.solution_parts.get("name")
     stu_name = state.student_parts.get("name")
 
-    if not isDefinedCollInProcess(sol_name, key, state.solution_process):
+    if not state.get_solution_result(
+        lambda: isDefinedCollInProcess(sol_name, key, state.solution_process),
+        "is_defined_coll",
+        state.solution_code,
+        sol_name,
+        key,
+    ):
         raise InstructorError.from_message(
             "`check_keys()` не удалось найти ключ `%s` в объекте `%s` в solution-коде."
             % (key, sol_name)
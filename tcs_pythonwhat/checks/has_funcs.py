@@ -3,7 +3,15 @@ from tcs_pythonwhat.tasks import (
     getResultInProcess,
     getOutputInProcess,
     getErrorInProcess,
+    getFingerprintedResultInProcess,
+    getCaseResultsInProcess,
+    getResultFromProcess,
+    taskRunEval,
+    dispatch,
+    compareValues,
+    RemoteValue,
     ReprFail,
+    SharedBuffers,
     isDefinedInProcess,
     getOptionFromProcess,
     UndefinedValue,
@@ -247,6 +255,12 @@ args_string = """
           will compare the {0} of the expression in the student process with the value specified in ``override``.
           Typically used in a ``SingleProcessExercise`` or if you want to allow for different solutions other than
           the one coded up in the solution.
+        compare_in_process (bool): only when comparing values, compare them inside the solution process,
+          so only the student value is transferred and neither is loaded in the grading process.
+          Useful for big values, ``func`` then runs in the solution process as well.
+        context_cases (list): a list of ``context_vals`` lists, to check the expression for every one of them.
+          All cases are evaluated in a single round trip to each process, which is a lot faster than
+          a ``multi()`` of ``set_context()`` calls for the same values.
     """
 
 
@@ -265,6 +279,8 @@ def has_expr(
     func=None,
     override=None,
     test=None,  # todo: default or arg before state
+    compare_in_process=False,
+    context_cases=None,
 ):
 
     if (
@@ -299,35 +315,74 @@ def has_expr(
         copy=copy,
     )
 
-    if override is not None:
-        # don't bother with running expression and fetching output/value
-        # eval_sol, str_sol = eval
-        eval_sol, str_sol = override, str(override)
-    else:
-        eval_sol, str_sol = get_func(
-            tree=state.solution_ast,
-            process=state.solution_process,
-            context=state.solution_context,
-            env=state.solution_env,
+    # values can be mapped from shared memory, release it after comparing them
+    with SharedBuffers.collect() as shared_buffers:
+        if context_cases is None:
+            evals = [
+                get_evals(
+                    state,
+                    get_func,
+                    override,
+                    test,
+                    # cached solution values are used instead, see get_evals
+                    compare_fingerprints=test == "value"
+                    and func is None
+                    and state.result_cache is None,
+                    compare_in_process=test == "value" and compare_in_process,
+                    func=func,
+                )
+            ]
+            releases = [partial(release_buffers, shared_buffers)]
+        else:
+            # the values of every case are released after comparing them
+            case_buffers = [[] for _ in context_cases]
+            evals = get_case_evals(
+                state, get_func, override, test, context_cases, case_buffers
+            )
+            releases = [partial(release_buffers, buffers) for buffers in case_buffers]
+
+    while evals:
+        check_evals(
+            state,
+            evals,
+            test=test,
+            incorrect_msg=incorrect_msg,
+            error_msg=error_msg,
+            undefined_msg=undefined_msg,
+            append=append,
+            name=name,
+            expr_code=expr_code,
+            func=func,
+            release=releases.pop(0),
         )
 
-        if (test == "error") ^ isinstance(eval_sol, Exception):
-            raise InstructorError.from_message(
-                "Выполнение выражения solution-кода вызвало ошибку (или не вызвала, если тестирование проводилось для одного). "
-                "Ошибка: {} - {}".format(type(eval_sol), str_sol)
-            )
-        if isinstance(eval_sol, ReprFail):
-            raise InstructorError.from_message(
-                "Не удалось извлечь значение для выделенного выражения из solution-кода:"
-                + eval_sol.info
-            )
+    return state
 
-    eval_stu, str_stu = get_func(
-        tree=state.student_ast,
-        process=state.student_process,
-        context=state.student_context,
-        env=state.student_env,
-    )
+
+def release_buffers(shared_buffers):
+    for buffers in shared_buffers:
+        buffers.release()
+
+
+def check_evals(
+    state,
+    evals,
+    test,
+    incorrect_msg,
+    error_msg,
+    undefined_msg,
+    append,
+    name,
+    expr_code,
+    func,
+    release,
+):
+    """Check the results of an expression, see ``has_expr``.
+
+    The results of the first case are taken from ``evals``,
+    so their values can be dropped once they are compared.
+    """
+    eval_sol, str_sol, eval_stu, str_stu = evals.pop(0)
 
     # kwargs ---
     fmt_kwargs = {
@@ -373,16 +428,191 @@ def has_expr(
         state.report(undefined_msg, fmt_kwargs, append=append)
 
     # test equality of results
-    state.do_test(
-        EqualTest(
-            eval_stu,
-            eval_sol,
-            FeedbackComponent(incorrect_msg, fmt_kwargs, append=append),
+    equal_test = EqualTest(
+        eval_stu,
+        eval_sol,
+        FeedbackComponent(incorrect_msg, fmt_kwargs, append=append),
+        # values compared in their processes stand in for the outcome
+        None if isinstance(eval_stu, RemoteValue) else func,
+        release=release,
+    )
+    del eval_stu, eval_sol
+    state.do_test(equal_test)
+
+
+def get_evals(
+    state,
+    get_func,
+    override,
+    test,
+    compare_fingerprints=False,
+    compare_in_process=False,
+    func=None,
+):
+    """Get the solution and student results of an expression, see ``has_expr``.
+
+    Both sides are evaluated at the same time, if they run in different processes.
+    With ``compare_fingerprints``, values are only fetched from the processes
+    if their fingerprints differ. With ``compare_in_process``, the values are compared
+    in the solution process instead of being fetched.
+    """
+    if override is not None:
+        # don't bother with running expression and fetching output/value
+        # eval_sol, str_sol = eval
+        eval_sol, str_sol = override, str(override)
+        eval_stu, str_stu = get_func(**side_kwargs(state, "student"))
+    elif compare_fingerprints or compare_in_process:
+        return get_remote_evals(
+            state, get_func.keywords, compare_fingerprints, compare_in_process, func
+        )
+    else:
+        (eval_sol, str_sol), (eval_stu, str_stu) = dispatch(
+            partial(
+                get_solution_result,
+                state,
+                partial(get_func, **side_kwargs(state, "solution")),
+                "has_expr",
+                test,
+                get_func.keywords,
+            ),
+            partial(get_func, **side_kwargs(state, "student")),
+            state.solution_process,
+            state.student_process,
+        )
+        check_sol_eval(eval_sol, str_sol, test)
+
+    return eval_sol, str_sol, eval_stu, str_stu
+
+
+def get_solution_result(state, compute, *key_parts):
+    """Get a result of the focused solution code from the result cache, see ``State.get_solution_result``."""
+    focus = {
+        key: value
+        for key, value in side_kwargs(state, "solution").items()
+        if key != "process"
+    }
+    return state.get_solution_result(compute, focus, *key_parts)
+
+
+def side_kwargs(state, side):
+    """Arguments of evaluation tasks for the ``"solution"`` or ``"student"`` side of a state."""
+    return {
+        "tree": getattr(state, side + "_ast"),
+        "process": getattr(state, side + "_process"),
+        "context": getattr(state, side + "_context"),
+        "env": getattr(state, side + "_env"),
+    }
+
+
+def get_remote_evals(
+    state, eval_kwargs, compare_fingerprints, compare_in_process, func
+):
+    run = getFingerprintedResultInProcess if compare_fingerprints else run_eval
+    # the solution result is kept under its own name, in case both run in the same process
+    sol_tempname = "_solution_object_"
+    stu_tempname = "_evaluation_object_"
+    (res_sol, sol_digest), (res_stu, stu_digest) = dispatch(
+        partial(
+            run,
+            tempname=sol_tempname,
+            **side_kwargs(state, "solution"),
+            **eval_kwargs
+        ),
+        partial(
+            run, tempname=stu_tempname, **side_kwargs(state, "student"), **eval_kwargs
+        ),
+        state.solution_process,
+        state.student_process,
+    )
+    check_sol_eval(res_sol, str(res_sol), "value")
+
+    if sol_digest is not None and sol_digest == stu_digest:
+        return (
+            RemoteValue(res_sol, True),
+            res_sol,
+            RemoteValue(res_stu, True),
+            res_stu,
+        )
+
+    if compare_in_process and not any(
+        isinstance(res, (UndefinedValue, Exception)) for res in (res_sol, res_stu)
+    ):
+        comparison = compareValues(
+            stu_tempname,
+            state.student_process,
+            sol_tempname,
+            state.solution_process,
             func,
         )
+        if not isinstance(comparison, ReprFail):
+            equal, stu_is_str, sol_is_str = comparison
+            return (
+                RemoteValue(res_sol, equal, sol_is_str),
+                res_sol,
+                RemoteValue(res_stu, equal, stu_is_str),
+                res_stu,
+            )
+
+    (eval_sol, str_sol), (eval_stu, str_stu) = dispatch(
+        partial(getResultFromProcess, res_sol, sol_tempname, state.solution_process),
+        partial(getResultFromProcess, res_stu, stu_tempname, state.student_process),
+        state.solution_process,
+        state.student_process,
     )
+    check_sol_eval(eval_sol, str_sol, "value")
+    return eval_sol, str_sol, eval_stu, str_stu
+
+
+def run_eval(**kwargs):
+    return taskRunEval(**kwargs), None
 
-    return state
+
+def get_case_evals(state, get_func, override, test, cases, case_buffers=None):
+    """Get the solution and student results of an expression for several ``context_vals``.
+
+    The ``SharedBuffers`` the values of a case are loaded from are added to ``case_buffers``.
+    """
+    kwargs = {
+        key: value for key, value in get_func.keywords.items() if key != "context_vals"
+    }
+    get_results = partial(
+        getCaseResultsInProcess, test, cases, case_buffers=case_buffers, **kwargs
+    )
+    if override is not None:
+        sol_results = [(override, str(override))] * len(cases)
+        stu_results = get_results(**side_kwargs(state, "student"))
+    else:
+        sol_results, stu_results = dispatch(
+            partial(
+                get_solution_result,
+                state,
+                partial(get_results, **side_kwargs(state, "solution")),
+                "has_expr_cases",
+                test,
+                cases,
+                kwargs,
+            ),
+            partial(get_results, **side_kwargs(state, "student")),
+            state.solution_process,
+            state.student_process,
+        )
+        for eval_sol, str_sol in sol_results:
+            check_sol_eval(eval_sol, str_sol, test)
+
+    return [sol + stu for sol, stu in zip(sol_results, stu_results)]
+
+
+def check_sol_eval(eval_sol, str_sol, test):
+    if (test == "error") ^ isinstance(eval_sol, Exception):
+        raise InstructorError.from_message(
+            "Выполнение выражения solution-кода вызвало ошибку (или не вызвала, если тестирование проводилось для одного). "
+            "Ошибка: {} - {}".format(type(eval_sol), str_sol)
+        )
+    if isinstance(eval_sol, ReprFail):
+        raise InstructorError.from_message(
+            "Не удалось извлечь значение для выделенного выражения из solution-кода:"
+            + eval_sol.info
+        )
 
 
 has_equal_value = partial(has_expr, test="value")
@@ -704,13 +934,21 @@ def has_printout(
             )
         )
 
-    out_sol, str_sol = getOutputInProcess(
-        tree=sol_call_ast,
-        process=state.solution_process,
-        context=state.solution_context,
-        env=state.solution_env,
-        pre_code=pre_code,
-        copy=copy,
+    out_sol, str_sol = get_solution_result(
+        state,
+        partial(
+            getOutputInProcess,
+            tree=sol_call_ast,
+            process=state.solution_process,
+            context=state.solution_context,
+            env=state.solution_env,
+            pre_code=pre_code,
+            copy=copy,
+        ),
+        "has_printout",
+        sol_call_ast,
+        pre_code,
+        copy,
     )
 
     sol_call_str = state.solution_ast_tokens.get_text(sol_call_ast)
@@ -1,10 +1,27 @@
+import gc
 import io
+import ast
+import mmap
+import pickle
+import struct
+import asyncio
 import os
+import hashlib
+import time
 import random
+import signal
+import resource
+import tempfile
 from pathlib import Path
+from types import SimpleNamespace
+from collections.abc import Mapping
+from threading import Lock
+from collections import OrderedDict
 from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
 
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Pipe
+from multiprocessing.reduction import ForkingPickler
 from tcs_protowhat.Reporter import Reporter
 
 try:
@@ -34,6 +51,12 @@ class StubProcess:
     def executeTask(self, task):
         return task(self.shell)
 
+    def executeTasks(self, tasks):
+        return [self.executeTask(task) for task in tasks]
+
+    async def executeTaskAsync(self, task):
+        return self.executeTask(task)
+
 
 class TaskCaptureOutput:
     def __init__(self, code):
@@ -48,6 +71,258 @@ class TaskKillProcess:
         return None
 
 
+class TaskChangeDir:
+    def __init__(self, path):
+        self.path = str(path)
+
+    def __call__(self, shell):
+        os.chdir(self.path)
+        return True
+
+
+class TaskBatch:
+    """Execute several tasks in one round trip, answering with the list of their answers.
+
+    A task that fails gets a backend error as answer, like it would on its own.
+    """
+
+    def __init__(self, tasks):
+        self.tasks = list(tasks)
+
+    def __call__(self, shell):
+        answers = []
+        for task in self.tasks:
+            try:
+                answers.append(task(shell))
+            except MemoryError:
+                raise
+            except Exception as e:
+                answers.append([{"type": "backend-error", "payload": str(e)}])
+        # a tuple, to tell it apart from the list of a backend error
+        return tuple(answers)
+
+
+class ChannelPickler(ForkingPickler):
+    """Pickler of ``Channel``, which sends AST nodes without their annotations.
+
+    Parsed nodes carry asttokens tokens, which hold the source lines, and wrappers;
+    tasks only need the fields and locations of a node.
+    """
+
+    def reducer_override(self, obj):
+        if isinstance(obj, ast.AST):
+            state = {
+                name: getattr(obj, name)
+                for name in obj._fields + obj._attributes
+                if hasattr(obj, name)
+            }
+            return type(obj), (), state
+        return NotImplemented
+
+
+class Channel:
+    """Duplex connection to or from a worker process, carrying tasks and answers.
+
+    Every object is sent as a single length-prefixed frame holding its pickle.
+    Pickle protocol 5 is used, which avoids copies when pickling large buffers.
+    The multiprocessing reducers stay in place, so connections can be sent along.
+    AST nodes are sent stripped, see ``ChannelPickler``.
+    """
+
+    protocol = 5
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def send(self, obj):
+        self.conn.send_bytes(ChannelPickler.dumps(obj, self.protocol))
+
+    def recv(self):
+        return pickle.loads(self.conn.recv_bytes())
+
+    def poll(self, timeout=0.0):
+        return self.conn.poll(timeout)
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def close(self):
+        self.conn.close()
+
+
+async def wait_readable(conn, timeout=None):
+    """Wait for an answer on a connection without blocking the event loop.
+
+    Returns whether there is an answer to receive before ``timeout`` seconds passed.
+    """
+    if conn.poll():
+        return True
+    loop = asyncio.get_running_loop()
+    readable = loop.create_future()
+    loop.add_reader(
+        conn.fileno(), lambda: readable.done() or readable.set_result(None)
+    )
+    try:
+        await asyncio.wait_for(readable, timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        loop.remove_reader(conn.fileno())
+
+
+class TaskLimitExceeded(Exception):
+    """Answer to a task that was stopped because it exceeded a limit of its worker.
+
+    The worker is stopped as well, so pools and caches replace it.
+
+    Args:
+        limit (str): ``"timeout"``, ``"cpu_time"``, ``"memory"`` or ``"rss"``.
+        value: the limit that was exceeded, in seconds or bytes.
+    """
+
+    def __init__(self, limit, value):
+        Exception.__init__(self, limit, value)
+        self.limit = limit
+        self.value = value
+
+    def __str__(self):
+        return "Task exceeded the %s limit of %s" % (self.limit, self.value)
+
+
+class TaskTimeout(TaskLimitExceeded):
+    pass
+
+
+class TaskOutOfMemory(TaskLimitExceeded):
+    pass
+
+
+class TaskLimits:
+    """Limits on every task a worker process executes.
+
+    The address space of the worker is limited with ``RLIMIT_AS``, so allocations beyond
+    ``memory`` fail inside the worker. The other limits are checked by the process
+    waiting for the answer, every ``interval`` seconds, and the worker is killed
+    when one of them is exceeded.
+
+    Args:
+        timeout (float): wall clock seconds a task may take.
+        cpu_time (float): CPU seconds a task may use.
+        memory (int): bytes of address space of the worker.
+        rss (int): bytes of resident memory of the worker.
+        interval (float): seconds between checks of the limits.
+    """
+
+    applied = None  # limits of the current worker process
+
+    def __init__(self, timeout=None, cpu_time=None, memory=None, rss=None, interval=0.05):
+        self.timeout = timeout
+        self.cpu_time = cpu_time
+        self.memory = memory
+        self.rss = rss
+        self.interval = interval
+
+    @property
+    def key(self):
+        """The values of the limits, to compare limits by."""
+        return (self.timeout, self.cpu_time, self.memory, self.rss, self.interval)
+
+    @property
+    def monitored(self):
+        return any(limit is not None for limit in [self.timeout, self.cpu_time, self.rss])
+
+    def apply(self):
+        """Limit the current (worker) process."""
+        if self.memory is not None:
+            resource.setrlimit(resource.RLIMIT_AS, (self.memory, self.memory))
+        TaskLimits.applied = self
+
+    def start(self, pid):
+        """Get the state to check the limits of a task against."""
+        cpu_time = process_cpu_time(pid) if self.cpu_time is not None else None
+        return time.monotonic(), cpu_time
+
+    def check(self, pid, started):
+        """Get the limit a task exceeded, ``None`` if it didn't exceed any."""
+        start_time, start_cpu_time = started
+        if self.timeout is not None and time.monotonic() - start_time > self.timeout:
+            return TaskTimeout("timeout", self.timeout)
+        if (
+            self.cpu_time is not None
+            and process_cpu_time(pid) - start_cpu_time > self.cpu_time
+        ):
+            return TaskTimeout("cpu_time", self.cpu_time)
+        if self.rss is not None and process_memory(pid) > self.rss:
+            return TaskOutOfMemory("rss", self.rss)
+        return None
+
+
+class LimitedWorker:
+    """Executing tasks in a worker process, within its ``TaskLimits``.
+
+    Subclasses reach their worker over a ``Channel`` in ``channel``.
+    Tasks of different workers can be executed at the same time, see ``tasks.dispatch``.
+    """
+
+    limits = None
+    limit_exceeded = None
+    concurrent_tasks = True
+
+    def executeTask(self, task):
+        if self.limit_exceeded is not None:
+            return self.limit_exceeded
+        self.channel.send(task)
+        if self.limits is None or not self.limits.monitored:
+            return self.check_answer(self.channel.recv())
+        started = self.limits.start(self.pid)
+        while not self.channel.poll(self.limits.interval):
+            exceeded = self.limits.check(self.pid, started)
+            if exceeded is not None:
+                return self.stop(exceeded)
+        return self.check_answer(self.channel.recv())
+
+    async def executeTaskAsync(self, task):
+        if self.limit_exceeded is not None:
+            return self.limit_exceeded
+        self.channel.send(task)
+        if self.limits is None or not self.limits.monitored:
+            await wait_readable(self.channel)
+            return self.check_answer(self.channel.recv())
+        started = self.limits.start(self.pid)
+        while not await wait_readable(self.channel, self.limits.interval):
+            exceeded = self.limits.check(self.pid, started)
+            if exceeded is not None:
+                return self.stop(exceeded)
+        return self.check_answer(self.channel.recv())
+
+    def executeTasks(self, tasks):
+        """Execute a list of tasks in a single round trip, returning the list of answers.
+
+        The limits apply to the tasks together.
+        """
+        answers = self.executeTask(TaskBatch(tasks))
+        if isinstance(answers, tuple):
+            return list(answers)
+        # the batch as a whole failed, e.g. because an answer can't be pickled
+        return [answers] * len(tasks)
+
+    def check_answer(self, answer):
+        if isinstance(answer, TaskLimitExceeded):
+            # the worker stops itself after running out of memory
+            return self.stop(answer)
+        return answer
+
+    def stop(self, exceeded):
+        """Kill the worker after it exceeded a limit."""
+        self.limit_exceeded = exceeded
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        return exceeded
+
+
 class CaptureErrors:
     def __init__(self, output):
         self.output = output
@@ -61,13 +336,48 @@ class CaptureErrors:
             return True
 
 
-class WorkerProcess(Process):
+def serve(shell, get_task, put_answer):
+    """Execute tasks on a shell until a TaskKillProcess is received.
+
+    When the memory limit of the worker is reached, the worker stops
+    after answering with a ``TaskOutOfMemory``.
+    """
+    limits = TaskLimits.applied
+    memory_limited = limits is not None and limits.memory is not None
+    while True:
+        output = []
+        answer = None
+        with CaptureErrors(output):
+            next_task = get_task()
+            try:
+                answer = next_task(shell)
+            except MemoryError as e:
+                if not memory_limited:
+                    raise
+                answer = e
+        out_of_memory = memory_limited and isinstance(answer, MemoryError)
+        if out_of_memory:
+            answer = TaskOutOfMemory("memory", limits.memory)
+        if len(output) > 0:  # means backend error happened
+            answer = output
+        output = []
+        with CaptureErrors(output):
+            put_answer(answer)
+        if len(output) > 0:  # means backend error happened
+            put_answer(output)
+        if isinstance(next_task, TaskKillProcess) or out_of_memory:
+            break  # break while loop -> we do not wait upon new task
+
+
+class WorkerProcess(LimitedWorker, Process):
     instances = []
 
-    def __init__(self, pid=None):
+    def __init__(self, pid=None, limits=None):
         Process.__init__(self)
-        self.task_queue = Queue()
-        self.result_queue = Queue()
+        self.limits = limits
+        # a single pipe, which an event loop can wait on
+        conn, self.worker_conn = Pipe()
+        self.channel = Channel(conn)
         self.daemon = (
             True
         )  # when parent process is killed, sub/childprocess get also killed
@@ -78,36 +388,26 @@ class WorkerProcess(Process):
     def get_shell(self):
         return create({})
 
-    def run(self):
-        shell = self.get_shell()
-        while True:
-            output = []
-            with CaptureErrors(output):
-                next_task = self.task_queue.get()
-                answer = next_task(shell)
-            if len(output) > 0:  # means backend error happened
-                answer = output
-            output = []
-            with CaptureErrors(output):
-                self.result_queue.put_nowait(answer)
-            if len(output) > 0:  # means backend error happened
-                self.result_queue.put_nowait(output)
-            if isinstance(next_task, TaskKillProcess):
-                break  # break while loop -> we do not wait upon new task
-        return
+    def start(self):
+        Process.start(self)
+        # the worker end is only used in the worker
+        self.worker_conn.close()
 
-    def executeTask(self, task):
-        self.task_queue.put_nowait(task)
-        return self.result_queue.get()  # wait and fetches next item in queue
+    def run(self):
+        if self.limits is not None:
+            self.limits.apply()
+        channel = Channel(self.worker_conn)
+        serve(self.get_shell(), channel.recv, channel.send)
 
     def kill(self):
         try:
             if self.is_alive():
                 self.executeTask(TaskKillProcess())
-                self.join(timeout=3.0)
+                self.wait_exit(timeout=3.0)
                 if self.is_alive():
                     self.terminate()
-                    self.join(timeout=3.0)
+                    self.wait_exit(timeout=3.0)
+            self.channel.close()
             if self in self.instances:
                 self.instances.remove(self)
         finally:
@@ -115,6 +415,13 @@ class WorkerProcess(Process):
             # python 3.7:
             # self.close()
 
+    def wait_exit(self, timeout):
+        # poll instead of join, as processes forked from this process
+        # (see TaskForkWorker) keep the sentinel used by join open
+        deadline = time.monotonic() + timeout
+        while self.is_alive() and time.monotonic() < deadline:
+            time.sleep(0.005)
+
     @classmethod
     def kill_all(cls):
         for instance in list(cls.instances):
@@ -126,6 +433,664 @@ class SimpleProcess(WorkerProcess):
         return StubShell()
 
 
+PROCESS_CLASSES = {"simple": SimpleProcess, "full": WorkerProcess}
+
+
+class WorkerPool:
+    """Pool of started worker processes for gradings.
+
+    Workers are forked from a parent process that never runs any code of an exercise,
+    so every worker starts out with a pristine interpreter.
+    A worker is checked out for a single grading and killed when it's checked in:
+    the code it ran may have changed the interpreter in ways that can't be undone,
+    e.g. by patching ``builtins``, and workers serve as solution and student processes alike.
+    On check in, a new worker is forked, so ``size`` workers are ready for the next gradings.
+    Workers that stayed idle for longer than ``idle_timeout`` seconds are killed.
+
+    Args:
+        size (int): number of idle workers to keep around (and to start upfront).
+        idle_timeout (float): seconds an idle worker is kept. ``None`` keeps it indefinitely.
+        mode (str): ``"simple"`` or ``"full"``, see ``run_single_process``.
+        limits (TaskLimits): limits on the tasks of the workers.
+    """
+
+    def __init__(self, size=2, idle_timeout=300, mode="simple", limits=None):
+        if mode not in PROCESS_CLASSES or (mode == "full" and not BACKEND_AVAILABLE):
+            raise ValueError("Invalid mode")
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.mode = mode
+        self.limits = limits
+        self.closed = False
+        self._idle = []  # (process, idle since) pairs, most recently used last
+        self._lock = Lock()
+        self._parent = None
+        self._parent_lock = Lock()
+        self.fill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._idle)
+
+    def _start(self):
+        if self._parent is None or not self._parent.is_alive():
+            if self._parent is not None:
+                self._parent.kill()
+            self._parent = PROCESS_CLASSES[self.mode](limits=self.limits)
+            self._parent.start()
+        return fork_worker(self._parent, self._parent_lock, limits=self.limits)
+
+    def fill(self):
+        """Start workers until the pool holds ``size`` idle workers."""
+        with self._lock:
+            self._prune()
+            while len(self._idle) < self.size:
+                self._idle.append((self._start(), time.monotonic()))
+
+    def _prune(self):
+        now = time.monotonic()
+        keep = []
+        for process, idle_since in self._idle:
+            expired = (
+                self.idle_timeout is not None and now - idle_since > self.idle_timeout
+            )
+            if expired or not process.is_alive():
+                process.kill()
+            else:
+                keep.append((process, idle_since))
+        self._idle = keep
+
+    def prune(self):
+        """Kill workers that have been idle for too long or died."""
+        with self._lock:
+            self._prune()
+
+    def checkout(self, pid=None):
+        """Get a started worker, starting a new one if no idle worker is available.
+
+        Args:
+            pid: identity to give the worker, used to detect single process exercises.
+        """
+        if self.closed:
+            raise ValueError("Pool is closed")
+        with self._lock:
+            self._prune()
+            process = self._idle.pop()[0] if self._idle else self._start()
+        process._identity = (pid,) if pid else (random.randint(0, 1e12),)
+        return process
+
+    def checkin(self, process):
+        """Kill a worker after its grading and start a new one in its place."""
+        self.discard(process)
+        if not self.closed:
+            self.fill()
+
+    def discard(self, process):
+        """Kill a worker instead of returning it to the pool."""
+        process.kill()
+
+    def close(self):
+        """Kill all idle workers. Checked out workers are killed on check in."""
+        with self._lock:
+            self.closed = True
+            idle, self._idle = self._idle, []
+            parent, self._parent = self._parent, None
+        for process, _ in idle:
+            process.kill()
+        if parent is not None:
+            parent.kill()
+
+
+class TaskForkWorker:
+    """Fork the process running this task, serving tasks in the child over ``conn``.
+
+    Objects created before the fork are moved to the permanent generation
+    of the garbage collector, so the memory pages holding them stay shared
+    between the forked workers.
+    """
+
+    forked_pids = set()
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __call__(self, shell):
+        self.reap()
+        gc.freeze()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                channel = Channel(self.conn)
+                serve(shell, channel.recv, channel.send)
+            finally:
+                os._exit(0)
+        self.conn.close()
+        self.forked_pids.add(pid)
+        return pid
+
+    @classmethod
+    def reap(cls):
+        for pid in list(cls.forked_pids):
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                    continue
+            except ChildProcessError:
+                pass
+            cls.forked_pids.remove(pid)
+
+
+class ForkedProcess(LimitedWorker):
+    """Worker process forked from a ``Zygote``, reached over a pipe."""
+
+    def __init__(self, conn, os_pid, pid=None, limits=None):
+        self.channel = Channel(conn)
+        self.pid = os_pid
+        self.limits = limits
+        self.killed = False
+        WorkerProcess.instances.append(self)
+        # used to detect single process exercise
+        self._identity = (pid,) if pid else (random.randint(0, 1e12),)
+
+    def is_alive(self):
+        if self.killed:
+            return False
+        try:
+            os.kill(self.pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def kill(self):
+        try:
+            if self.is_alive():
+                try:
+                    self.executeTask(TaskKillProcess())
+                except (EOFError, OSError):
+                    os.kill(self.pid, signal.SIGKILL)
+            self.channel.close()
+        except OSError:
+            pass
+        finally:
+            self.killed = True
+            if self in WorkerProcess.instances:
+                WorkerProcess.instances.remove(self)
+
+
+def fork_worker(process, lock, pid=None, limits=None):
+    """Fork a worker from a started worker process, see ``TaskForkWorker``.
+
+    ``lock`` keeps other threads from using the process while it forks.
+    """
+    conn, child_conn = Pipe()
+    with lock:
+        os_pid = process.executeTask(TaskForkWorker(child_conn))
+    child_conn.close()
+    if not isinstance(os_pid, int):
+        conn.close()
+        raise RuntimeError("Forking the worker failed: %s" % os_pid)
+    return ForkedProcess(conn, os_pid, pid, limits)
+
+
+class Zygote:
+    """Process that ran the pre exercise code once, to fork workers from.
+
+    Forked workers start out with the namespace of the zygote,
+    so the pre exercise code isn't rerun for every solution and submission.
+
+    Args:
+        pec (str): pre exercise code to run in the zygote.
+        mode (str): ``"simple"`` or ``"full"``, see ``run_single_process``.
+        wd (str): working directory of the zygote and the workers forked from it.
+        limits (TaskLimits): limits on the tasks of the zygote and the forked workers.
+        code (str): code to run after the pre exercise code, e.g. the solution code.
+    """
+
+    def __init__(self, pec, mode="simple", wd=None, limits=None, code=None):
+        if mode not in PROCESS_CLASSES or (mode == "full" and not BACKEND_AVAILABLE):
+            raise ValueError("Invalid mode")
+        self.mode = mode
+        self.lock = Lock()
+        self.limits = limits
+        self.process = PROCESS_CLASSES[mode](limits=limits)
+        self.process.start()
+        if wd is not None:
+            self.process.executeTask(TaskChangeDir(wd))
+        self.pec_output, self.pec_error = execute_in_process(
+            self.process, None, pec, mode
+        )
+        if code is not None:
+            self.output, self.error = execute_in_process(
+                self.process, None, code, mode
+            )
+
+    def fork(self, pid=None):
+        """Fork a worker holding the namespace created by the pre exercise code."""
+        return fork_worker(self.process, self.lock, pid, self.limits)
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def kill(self):
+        with self.lock:
+            self.process.kill()
+
+
+MAX_ZYGOTES = 8
+zygotes = OrderedDict()  # key -> zygote, least recently used first
+zygotes_lock = Lock()
+
+
+def get_zygote(pec, mode="simple", wd=None, limits=None):
+    """Get the zygote for the pre exercise code in a working directory.
+
+    ``wd`` defaults to the current working directory.
+    At most ``MAX_ZYGOTES`` zygotes are kept, the least recently used ones are killed.
+    """
+    wd = str(wd or os.getcwd())
+    key = (
+        hashlib.sha256(pec.encode()).hexdigest(),
+        mode,
+        wd,
+        limits.key if limits is not None else None,
+    )
+    evicted = []
+    with zygotes_lock:
+        zygote = zygotes.get(key)
+        if zygote is None or not zygote.is_alive():
+            if zygote is not None:
+                evicted.append(zygote)
+            zygote = zygotes[key] = Zygote(pec, mode, wd, limits)
+        zygotes.move_to_end(key)
+        while len(zygotes) > MAX_ZYGOTES:
+            evicted.append(zygotes.popitem(last=False)[1])
+    for old_zygote in evicted:
+        old_zygote.kill()
+    return zygote
+
+
+def kill_zygotes():
+    for key in list(zygotes):
+        zygotes.pop(key).kill()
+
+
+def process_memory(pid):
+    """Resident memory of a worker process in bytes, 0 if it can't be determined."""
+    try:
+        with open("/proc/%d/statm" % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, TypeError):
+        return 0
+
+
+def process_cpu_time(pid):
+    """CPU seconds used by a worker process, 0 if it can't be determined."""
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            # skip the process name, which can contain spaces
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, TypeError, IndexError):
+        return 0
+
+
+class SolutionCache:
+    """Cache of processes that already ran the solution code of an exercise, to fork from.
+
+    For a given pre exercise code, solution code and working directory,
+    the solution process is the same for every submission.
+    The cache keeps a ``Zygote`` that ran the solution code and lends out workers forked from it,
+    one per grading, so evaluations in a grading can't change the solution process of another.
+    Borrowed workers are killed when they're released.
+    The least recently used zygotes are killed when the cache holds more than
+    ``max_size`` zygotes or when their combined resident memory exceeds ``max_memory`` bytes.
+    In stub mode nothing is cached and the solution code runs for every borrow.
+
+    Args:
+        max_size (int): maximum number of cached zygotes.
+        max_memory (int): maximum combined resident memory in bytes. ``None`` for no limit.
+        process_kwargs: passed on to ``run_single_process`` to create solution processes.
+    """
+
+    def __init__(self, max_size=16, max_memory=None, **process_kwargs):
+        self.max_size = max_size
+        self.max_memory = max_memory
+        self.process_kwargs = process_kwargs
+        self._zygotes = OrderedDict()  # key -> zygote, least recently used first
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._zygotes)
+
+    @staticmethod
+    def get_key(pec, sol_code, wd):
+        content = "\0".join([pec, sol_code, str(wd)])
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def borrow(self, pec, sol_code, wd=None, pid=None):
+        """Get a worker that ran the solution code, running it if no zygote is cached for it."""
+        wd = str(wd or os.getcwd())
+        mode = self.process_kwargs.get("mode", "simple")
+        if mode == "stub":
+            process, _, _ = run_single_process(
+                pec, sol_code, pid, wd=wd, **self.process_kwargs
+            )
+            return process
+        key = self.get_key(pec, sol_code, wd)
+        with self._lock:
+            zygote = self._zygotes.get(key)
+            if zygote is not None:
+                self._zygotes.move_to_end(key)
+        if zygote is None or not zygote.is_alive():
+            zygote = self._add(
+                key,
+                Zygote(pec, mode, wd, self.process_kwargs.get("limits"), sol_code),
+            )
+        process = zygote.fork(pid)
+        with self._lock:
+            evicted = self._evict()
+        for old_zygote in evicted:
+            old_zygote.kill()
+        return process
+
+    async def borrow_async(self, pec, sol_code, wd=None, pid=None):
+        """Like ``borrow``, without blocking the event loop while the solution code runs."""
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.borrow, pec, sol_code, wd, pid
+        )
+
+    def _add(self, key, zygote):
+        with self._lock:
+            cached = self._zygotes.get(key)
+            if cached is not None and cached.is_alive():
+                # another grading ran the same solution in the meantime
+                evicted = [zygote]
+                zygote = cached
+            else:
+                self._zygotes[key] = zygote
+                evicted = [cached] if cached is not None else []
+            self._zygotes.move_to_end(key)
+        for old_zygote in evicted:
+            old_zygote.kill()
+        return zygote
+
+    def release(self, process):
+        """Kill a borrowed worker, the zygote it was forked from stays cached."""
+        if hasattr(process, "kill"):
+            process.kill()
+
+    def _evict(self):
+        evicted = []
+        while self._zygotes and (
+            len(self) > self.max_size
+            or (self.max_memory is not None and self.memory() > self.max_memory)
+        ):
+            evicted.append(self._zygotes.popitem(last=False)[1])
+        return evicted
+
+    def memory(self):
+        return sum(
+            process_memory(zygote.process.pid) for zygote in self._zygotes.values()
+        )
+
+    def clear(self):
+        """Kill all cached zygotes."""
+        with self._lock:
+            zygotes, self._zygotes = self._zygotes, OrderedDict()
+        for zygote in zygotes.values():
+            zygote.kill()
+
+
+class DeferredProcess:
+    """Stand-in for a process that is only started when a task has to run in it.
+
+    Used for the solution process when its results are expected to be precomputed,
+    see ``ExerciseBundle``. Other attributes are taken from the started process.
+
+    Args:
+        start (callable): returns the process.
+        stop (callable): called with the process, if it was started, by ``release``.
+    """
+
+    concurrent_tasks = False
+
+    def __init__(self, start, stop):
+        self._start = start
+        self._stop = stop
+        self._process = None
+        self._lock = Lock()
+        self._identity = (random.randint(0, 1e12),)
+
+    @property
+    def started(self):
+        return self._process is not None
+
+    @property
+    def process(self):
+        with self._lock:
+            if self._process is None:
+                self._process = self._start()
+        return self._process
+
+    def executeTask(self, task):
+        return self.process.executeTask(task)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.process, name)
+
+    def release(self):
+        if self._process is not None:
+            self._stop(self._process)
+            self._process = None
+
+
+class KeyPickler(pickle.Pickler):
+    """Pickler for the parts of ``ResultCache`` keys, reducing AST nodes and contexts to their content.
+
+    Sets are reduced to the sorted pickles of their items,
+    as the order of their items depends on the hash seed of the process.
+    """
+
+    def __init__(self, file, protocol=None):
+        super().__init__(file, protocol)
+        self.protocol = protocol
+        # without the memo, equal parts give the same stream whether or not they are the same object
+        self.fast = True
+
+    def reducer_override(self, obj):
+        if isinstance(obj, ast.AST):
+            return str, (ast.dump(obj),)
+        if isinstance(obj, Mapping) and not isinstance(obj, dict):
+            return dict, (dict(obj),)
+        return NotImplemented
+
+    def persistent_id(self, obj):
+        # called for every object, while sets don't go through reducer_override
+        if isinstance(obj, (set, frozenset)):
+            return type(obj).__name__, tuple(sorted(self.dumps(item) for item in obj))
+        return None
+
+    def dumps(self, obj):
+        stream = io.BytesIO()
+        KeyPickler(stream, self.protocol).dump(obj)
+        return stream.getvalue()
+
+
+class ResultCache:
+    """Cache of the results of the solution side of checks, shared by gradings.
+
+    For a given exercise, a check evaluates the solution code in the same way
+    for every submission, so once a check ran, its solution side can be taken from here.
+    Results are kept pickled, so gradings can't change them, under a digest of
+    the exercise and the check step, see ``State.get_solution_result``.
+    The least recently used results are dropped when more than ``max_size`` are kept
+    or their pickles take more than ``max_memory`` bytes.
+
+    Args:
+        max_size (int): maximum number of results kept in memory.
+        max_memory (int): maximum size of the results kept in memory, in bytes.
+        directory (str): if specified, results are stored in this directory as well,
+          to share them with other grading processes and keep them across restarts.
+    """
+
+    def __init__(self, max_size=4096, max_memory=256 * 2 ** 20, directory=None):
+        self.max_size = max_size
+        self.max_memory = max_memory
+        self.directory = directory
+        self._results = OrderedDict()  # key -> pickle, least recently used first
+        self._memory = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._results)
+
+    @staticmethod
+    def get_key(*parts):
+        """Digest of the parts of a key, or ``None`` if they can't be pickled."""
+        digest = hashlib.sha256()
+        pickler = KeyPickler(SimpleNamespace(write=digest.update), protocol=4)
+        try:
+            pickler.dump(parts)
+        except Exception:
+            return None
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Get a result, or ``None`` if it isn't cached."""
+        with self._lock:
+            stream = self._results.get(key)
+            if stream is not None:
+                self._results.move_to_end(key)
+        if stream is None and self.directory is not None:
+            try:
+                with open(os.path.join(self.directory, key), "rb") as f:
+                    stream = f.read()
+            except OSError:
+                pass
+            else:
+                self._store(key, stream)
+        if stream is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(stream)
+
+    def put(self, key, result):
+        try:
+            stream = pickle.dumps(result, protocol=5)
+        except Exception:
+            return  # e.g. values that can only be dilled
+        self._store(key, stream)
+        if self.directory is not None:
+            fd, path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+            with os.fdopen(fd, "wb") as f:
+                f.write(stream)
+            os.replace(path, os.path.join(self.directory, key))
+
+    def _store(self, key, stream):
+        if len(stream) > self.max_memory:
+            return
+        with self._lock:
+            previous = self._results.pop(key, None)
+            if previous is not None:
+                self._memory -= len(previous)
+            self._results[key] = stream
+            self._memory += len(stream)
+            while len(self._results) > self.max_size or self._memory > self.max_memory:
+                _, evicted = self._results.popitem(last=False)
+                self._memory -= len(evicted)
+
+    def clear(self):
+        """Drop all results kept in memory."""
+        with self._lock:
+            self._results.clear()
+            self._memory = 0
+
+    def save(self, path, **header):
+        """Write the results kept in memory to an ``ExerciseBundle`` file, along with ``header``."""
+        with self._lock:
+            results = list(self._results.items())
+        index = {}
+        offset = 0
+        for key, stream in results:
+            index[key] = (offset, len(stream))
+            offset += len(stream)
+        header_stream = pickle.dumps({**header, "index": index}, protocol=5)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), prefix=".tmp-"
+        )
+        with os.fdopen(fd, "wb") as f:
+            f.write(ExerciseBundle.magic)
+            f.write(struct.pack("<Q", len(header_stream)))
+            f.write(header_stream)
+            for _, stream in results:
+                f.write(stream)
+        os.replace(tmp_path, path)
+
+
+class ExerciseBundle(ResultCache):
+    """Solution results of an exercise, precomputed by ``compile_exercise`` and memory mapped.
+
+    The file holds a header with the parsed solution code and the parser outputs for it,
+    followed by the pickled results, which are only loaded when a check asks for them.
+    The pages of the mapping are shared by all gradings and processes that load the bundle.
+    Results that are missing from the file are cached in memory, as in ``ResultCache``.
+
+    Args:
+        path (str): the file written by ``compile_exercise``.
+        kwargs: passed on to ``ResultCache``.
+    """
+
+    magic = b"PYWHATB1"
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        with open(path, "rb") as f:
+            self._mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mapping)
+        if bytes(view[: len(self.magic)]) != self.magic:
+            raise ValueError("%s is not an exercise bundle" % path)
+        start = len(self.magic) + 8
+        (header_size,) = struct.unpack("<Q", view[len(self.magic) : start])
+        header = pickle.loads(view[start : start + header_size])
+        self._data = view[start + header_size :]
+        self.index = header.pop("index")
+        self.pre_exercise_code = header.pop("pre_exercise_code")
+        self.solution_code = header.pop("solution_code")
+        self.solution_ast_tokens = header.pop("solution_ast_tokens")
+        self.solution_ast = header.pop("solution_ast")
+        # (node, {parser name: parser}) as in Dispatcher._parser_cache
+        self.parser_outputs = header.pop("parser_outputs")
+
+    def matches(self, pre_exercise_code, solution_code):
+        return (
+            self.pre_exercise_code == pre_exercise_code
+            and self.solution_code == solution_code
+        )
+
+    def get(self, key):
+        location = self.index.get(key)
+        if location is None:
+            return super().get(key)
+        offset, size = location
+        self.hits += 1
+        return pickle.loads(self._data[offset : offset + size])
+
+    def put(self, key, result):
+        if key not in self.index:
+            super().put(key, result)
+
+
 class ChDir(object):
     """
     Step into a directory temporarily.
@@ -150,49 +1115,203 @@ def run_code(executor, code):
             raw_output = output.getvalue()
             error = None
         except BaseException as e:
+            if isinstance(e, MemoryError) and TaskLimits.applied is not None:
+                raise  # the worker answers that it ran out of memory
             raw_output = ""
             error = str(e)
     return raw_output, error
 
 
-def run_single_process(pec, code, pid=None, mode="simple"):
-    if mode == "stub":
-        # no isolation
-        process = StubProcess(init_code=pec, pid=pid)
-        raw_output, error = run_code(process.shell.run_code, code)
+def get_execution_tasks(pec, code, mode="simple", wd=None):
+    tasks = [TaskChangeDir(wd)] if wd is not None else []
+    if mode == "full":
+        if pec is not None:
+            tasks.append(TaskCaptureFullOutput((pec,), "<PEC>", None, silent=True))
+        tasks.append(TaskCaptureFullOutput((code,), "script.py", None, silent=True))
+    else:
+        if pec is not None:
+            tasks.append(TaskCaptureOutput(pec))
+        tasks.append(TaskCaptureOutput(code))
+    return tasks
 
-    elif mode == "simple":
-        # no advanced functionality
-        process = SimpleProcess(pid)
-        process.start()
-        _ = process.executeTask(TaskCaptureOutput(pec))
-        raw_output, error = process.executeTask(TaskCaptureOutput(code))
 
-    elif mode == "full" and BACKEND_AVAILABLE:
-        # slow
-        process = WorkerProcess(pid)
-        process.start()
-        _ = process.executeTask(
-            TaskCaptureFullOutput((pec,), "<PEC>", None, silent=True)
-        )
-        output, raw_output = process.executeTask(
-            TaskCaptureFullOutput((code,), "script.py", None, silent=True)
-        )
+def get_execution_result(answer, mode="simple"):
+    if isinstance(answer, TaskLimitExceeded):
+        return "", str(answer)
+    elif mode == "full":
+        output, raw_output = answer
         raw_output = raw_output["output_stream"]
         error = raw_output["error"]
+    else:
+        raw_output, error = answer
+
+    return raw_output, error
+
+
+def execute_in_process(process, pec, code, mode="simple", wd=None):
+    for task in get_execution_tasks(pec, code, mode, wd):
+        answer = process.executeTask(task)
+        if isinstance(answer, TaskLimitExceeded):
+            break
+    return get_execution_result(answer, mode)
+
+
+async def execute_in_process_async(process, pec, code, mode="simple", wd=None):
+    for task in get_execution_tasks(pec, code, mode, wd):
+        answer = await process.executeTaskAsync(task)
+        if isinstance(answer, TaskLimitExceeded):
+            break
+    return get_execution_result(answer, mode)
+
+
+def start_process(
+    pec, pid=None, mode="simple", pool=None, zygote=False, wd=None, limits=None
+):
+    """Get a worker process to run code in for ``run_single_process``.
+
+    Returns the process, the mode it runs in and the pre exercise code and working directory
+    it still has to be given, ``None`` if it doesn't need them.
+    """
+    if zygote and mode != "stub":
+        # fork from a process that already ran the pre exercise code
+        return get_zygote(pec, mode, wd, limits).fork(pid), mode, None, None
+
+    elif pool is not None:
+        # take a freshly forked worker, moved into the working directory
+        return pool.checkout(pid), pool.mode, pec, str(wd or os.getcwd())
+
+    elif mode == "simple" or (mode == "full" and BACKEND_AVAILABLE):
+        # simple: no advanced functionality, full: slow
+        process = PROCESS_CLASSES[mode](pid, limits)
+        process.start()
+        if wd is not None and str(wd) != os.getcwd():
+            return process, mode, pec, str(wd)
+        return process, mode, pec, None
 
     else:
         raise ValueError("Invalid mode")
 
+
+def run_single_process(
+    pec,
+    code,
+    pid=None,
+    mode="simple",
+    pool=None,
+    zygote=False,
+    wd=None,
+    limits=None,
+):
+    """Run code in a new process, after running the pre exercise code.
+
+    Except in ``"stub"`` mode, the code runs in ``wd`` without changing
+    the working directory of the current process, so that several processes
+    can be set up at the same time.
+    ``wd`` defaults to the current working directory.
+    ``limits`` are the ``TaskLimits`` of a new process,
+    a process from a pool has the limits of the pool.
+    """
+    if mode == "stub" and pool is None:
+        # no isolation
+        with ChDir(wd or os.getcwd()):
+            process = StubProcess(init_code=pec, pid=pid)
+            raw_output, error = run_code(process.shell.run_code, code)
+        return process, raw_output, error
+
+    process, mode, pec, wd = start_process(pec, pid, mode, pool, zygote, wd, limits)
+    raw_output, error = execute_in_process(process, pec, code, mode, wd)
+
     return process, raw_output, error
 
 
-def run_exercise(pec, sol_code, stu_code, sol_wd=None, stu_wd=None, **kwargs):
-    with ChDir(sol_wd or os.getcwd()):
-        sol_process, _, _ = run_single_process(pec, sol_code, **kwargs)
+async def run_single_process_async(
+    pec,
+    code,
+    pid=None,
+    mode="simple",
+    pool=None,
+    zygote=False,
+    wd=None,
+    limits=None,
+):
+    """Like ``run_single_process``, awaiting the code execution in the process."""
+    if mode == "stub" and pool is None:
+        return run_single_process(pec, code, pid, mode, wd=wd)
 
-    with ChDir(stu_wd or os.getcwd()):
-        stu_process, raw_stu_output, error = run_single_process(pec, stu_code, **kwargs)
+    process, mode, pec, wd = start_process(pec, pid, mode, pool, zygote, wd, limits)
+    raw_output, error = await execute_in_process_async(process, pec, code, mode, wd)
+
+    return process, raw_output, error
+
+
+def run_exercise(
+    pec,
+    sol_code,
+    stu_code,
+    sol_wd=None,
+    stu_wd=None,
+    concurrent=True,
+    solution_cache=None,
+    **kwargs
+):
+    """Run the solution and student code, each in their own process.
+
+    Unless ``concurrent`` is ``False`` or the ``"stub"`` mode is used,
+    the solution and student processes are set up at the same time.
+    If a ``SolutionCache`` is passed, the solution process is borrowed from it;
+    release it to the cache again once the grading is done.
+    """
+    sol_wd = sol_wd or os.getcwd()
+    stu_wd = stu_wd or os.getcwd()
+
+    def run_solution():
+        if solution_cache is not None:
+            return solution_cache.borrow(pec, sol_code, sol_wd, kwargs.get("pid"))
+        return run_single_process(pec, sol_code, wd=sol_wd, **kwargs)[0]
+
+    if not concurrent or kwargs.get("mode") == "stub":
+        sol_process = run_solution()
+        stu_process, raw_stu_output, error = run_single_process(
+            pec, stu_code, wd=stu_wd, **kwargs
+        )
+        return sol_process, stu_process, raw_stu_output, error
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        sol_future = executor.submit(run_solution)
+        stu_future = executor.submit(
+            run_single_process, pec, stu_code, wd=stu_wd, **kwargs
+        )
+        sol_process = sol_future.result()
+        stu_process, raw_stu_output, error = stu_future.result()
+
+    return sol_process, stu_process, raw_stu_output, error
+
+
+async def run_exercise_async(
+    pec, sol_code, stu_code, sol_wd=None, stu_wd=None, solution_cache=None, **kwargs
+):
+    """Like ``run_exercise``, awaiting the solution and student code at the same time."""
+    sol_wd = sol_wd or os.getcwd()
+    stu_wd = stu_wd or os.getcwd()
+
+    async def run_solution():
+        if solution_cache is not None:
+            return await solution_cache.borrow_async(
+                pec, sol_code, sol_wd, kwargs.get("pid")
+            )
+        return (await run_single_process_async(pec, sol_code, wd=sol_wd, **kwargs))[0]
+
+    if kwargs.get("mode") == "stub":
+        # stub processes change the working directory, one at a time
+        sol_process = await run_solution()
+        stu_process, raw_stu_output, error = await run_single_process_async(
+            pec, stu_code, wd=stu_wd, **kwargs
+        )
+        return sol_process, stu_process, raw_stu_output, error
+
+    sol_process, (stu_process, raw_stu_output, error) = await asyncio.gather(
+        run_solution(), run_single_process_async(pec, stu_code, wd=stu_wd, **kwargs)
+    )
 
     return sol_process, stu_process, raw_stu_output, error
 
@@ -285,9 +1404,12 @@ def run(state, relative_working_dir=None, solution_dir="../solution", run_soluti
         sol_wd=sol_wd,
         stu_wd=stu_wd,
     )
-    return state.to_child(
+    child = state.to_child(
         student_process=stu_process,
         solution_process=sol_process,
         raw_student_output=raw_stu_output,
         reporter=Reporter(state.reporter, errors=[error] if error else []),
     )
+    # the solution results of checks on the child depend on how its process was set up
+    child.solution_setup = (sol_code, str(solution_dir), str(relative_working_dir))
+    return child
@@ -182,6 +182,55 @@ class Parser(ast.NodeVisitor):
         }
 
 
+class StatementFilter:
+    """Filter of the top-level statements of a module, by type, built in a single pass.
+
+    A parser visits the statements of a module body in turn, and those without
+    a ``visit_`` method on the parser go to the no-op ``generic_visit``.
+    Running a parser on the statements the filter selects for it therefore gives
+    the same output as visiting the module, skipping the statements it ignores.
+    This is not an index of parser outputs: a parser still walks every statement it
+    handles, including the nodes below it, so it only saves time on bodies with many
+    top-level statements the parser ignores.
+    """
+
+    def __init__(self, node):
+        self.body = node.body
+        # statement type name -> positions in the body,
+        # expression statements are indexed by the type of their value
+        self.positions = {}
+        for position, line in enumerate(node.body):
+            if isinstance(line, ast.Expr):
+                key = ("Expr", type(line.value).__name__)
+            else:
+                key = type(line).__name__
+            self.positions.setdefault(key, []).append(position)
+
+    def get_lines(self, parser):
+        """The statements the parser has a ``visit_`` method for, in the order of the body."""
+        positions = [
+            position
+            for key, positions in self.positions.items()
+            if self.is_visited(parser, key)
+            for position in positions
+        ]
+        return [self.body[position] for position in sorted(positions)]
+
+    @staticmethod
+    def is_visited(parser, key):
+        if isinstance(key, tuple):
+            if type(parser).visit_Expr is not Parser.visit_Expr:
+                return True
+            # Parser.visit_Expr only passes the value on
+            key = key[1]
+        return hasattr(parser, "visit_" + key)
+
+    def visit(self, parser):
+        """Visit the module with a parser that keeps ``Parser.visit_Module``."""
+        for line in self.get_lines(parser):
+            parser.visit(line)
+
+
 # class OperatorParser(Parser):
 #     """Find operations.
 
@@ -314,9 +363,6 @@ class FunctionParser(Parser):
         for imp in node.names:
             self.mappings[imp.asname or imp.name] = node.module + "." + imp.name
 
-    def visit_Expr(self, node):
-        self.visit(node.value)
-
     def visit_List(self, node):
         [self.visit(el) for el in node.elts]
 
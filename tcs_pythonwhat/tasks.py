@@ -1,14 +1,25 @@
 from tcs_pythonwhat import utils
 import dill
 import pickle
+import numpy as np
+import pandas as pd
 import tcs_pythonwhat
+import os
 import ast
+import mmap
+import hashlib
 import inspect
+import tempfile
 from copy import deepcopy
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextvars import ContextVar, copy_context
+from types import SimpleNamespace
 from pickle import PicklingError
 from tcs_pythonwhat.utils_env import set_context_vals, assign_from_ast
-from contextlib import contextmanager
-from functools import partial, wraps
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache, partial, wraps
+from weakref import WeakKeyDictionary
 from tcs_protowhat.failure import InstructorError
 
 
@@ -17,7 +28,12 @@ from tcs_protowhat.failure import InstructorError
 
 
 def process_task(f):
-    """Decorator to (optionally) run function in a process."""
+    """Decorator to (optionally) run function in a process.
+
+    ``task.run_async(...)`` is a coroutine version that awaits the process
+    without blocking the event loop.
+    ``task.defer(collector, ...)`` adds the task to a ``TaskCollector`` instead.
+    """
     sig = inspect.signature(f)
 
     @wraps(f)
@@ -35,9 +51,112 @@ def process_task(f):
         # otherwise, run original function
         return f(*ba.args, **ba.kwargs)
 
+    async def run_async(*args, **kwargs):
+        """Like the task itself, but awaits the answer of the process."""
+        ba = sig.bind_partial(*args, **kwargs)
+        process = ba.arguments.get("process")
+        if process:
+            ba.arguments["process"] = None
+            pf = partial(wrapper, *ba.args, **ba.kwargs)
+            return await process.executeTaskAsync(pf)
+        return f(*ba.args, **ba.kwargs)
+
+    def defer(collector, *args, **kwargs):
+        """Add the task to a ``TaskCollector``, returning a ``DeferredAnswer``."""
+        ba = sig.bind_partial(*args, **kwargs)
+        ba.arguments["process"] = None
+        return collector.add(partial(wrapper, *ba.args, **ba.kwargs))
+
+    wrapper.run_async = run_async
+    wrapper.defer = defer
     return wrapper
 
 
+class DeferredAnswer:
+    """Answer of a task in a ``TaskCollector``, available once the tasks are executed."""
+
+    def __init__(self):
+        self.done = False
+        self.answer = None
+
+    def get(self):
+        if not self.done:
+            raise ValueError("The collected tasks haven't been executed yet.")
+        return self.answer
+
+
+class TaskCollector:
+    """Collect process tasks to execute them in a single round trip.
+
+    Tasks are added with ``task.defer(collector, ...)``, leaving out the process.
+    They are executed when the ``with`` block ends, or when calling ``execute``::
+
+        with TaskCollector(process) as collector:
+            defined = isDefinedInProcess.defer(collector, "x")
+            columns = getColumnsInProcess.defer(collector, "df")
+        defined.get(), columns.get()
+    """
+
+    def __init__(self, process):
+        self.process = process
+        self.tasks = []
+        self.answers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def add(self, task):
+        self.tasks.append(task)
+        self.answers.append(DeferredAnswer())
+        return self.answers[-1]
+
+    def execute(self):
+        tasks, self.tasks = self.tasks, []
+        answers, self.answers = self.answers, []
+        if not tasks:
+            return
+        execute_tasks = getattr(self.process, "executeTasks", None)
+        if execute_tasks is None:
+            # processes from elsewhere execute one task at a time
+            results = [self.process.executeTask(task) for task in tasks]
+        else:
+            results = execute_tasks(tasks)
+        for answer, result in zip(answers, results):
+            answer.answer = result
+            answer.done = True
+
+
+# runs the solution side of a check while the student side runs in the calling thread
+dispatch_executor = ThreadPoolExecutor(thread_name_prefix="pythonwhat-dispatch")
+
+
+def dispatch(sol_call, stu_call, sol_process, stu_process):
+    """Call a function for the solution and one for the student process, returning both results.
+
+    If the processes are different workers, the calls run at the same time.
+    An exception of the solution call is raised first, as when calling them in turn.
+    """
+    if sol_process is stu_process or not all(
+        getattr(process, "concurrent_tasks", False)
+        for process in (sol_process, stu_process)
+    ):
+        return sol_call(), stu_call()
+    # run in a copy of the context, to see the root state of the SCT
+    future = dispatch_executor.submit(copy_context().run, sol_call)
+    try:
+        stu_result = stu_call()
+    except BaseException:
+        wait([future])
+        if future.exception() is not None:
+            raise future.exception()
+        raise
+    return future.result(), stu_result
+
+
 def get_env(ns):
     if "__env__" in ns:
         return ns["__env__"]
@@ -45,6 +164,25 @@ def get_env(ns):
         return ns
 
 
+def get_registry(shell):
+    """Get the storage pythonwhat keeps on a shell, outside of its namespace."""
+    registry = getattr(shell, "pythonwhat_registry", None)
+    if registry is None:
+        registry = shell.pythonwhat_registry = {
+            "results": {},
+            "converters": {},
+        }
+    return registry
+
+
+def get_value(shell, name):
+    """Get a stored evaluation result or else a variable from the namespace."""
+    results = get_registry(shell)["results"]
+    if name in results:
+        return results[name]
+    return get_env(shell.user_ns)[name]
+
+
 @contextmanager
 def capture_output():
     import sys
@@ -137,14 +275,23 @@ def get_signature(name, mapped_name, signature, manual_sigs, env):
     return signature
 
 
+@lru_cache(maxsize=None)
+def get_resident_manual_sigs():
+    """Manual signatures, created once in every process that needs them."""
+    from tcs_pythonwhat.signatures import get_manual_sigs
+
+    return get_manual_sigs()
+
+
 # Get the signature of a function based on an object inside the process
+# If manual_sigs is None, the manual signatures resident in the process are used
 @process_task
 def getSignatureInProcess(name, mapped_name, signature, manual_sigs, process, shell):
     return get_signature(
         name=name,
         mapped_name=mapped_name,
         signature=signature,
-        manual_sigs=manual_sigs,
+        manual_sigs=get_resident_manual_sigs() if manual_sigs is None else manual_sigs,
         env=get_env(shell.user_ns),
     )
 
@@ -215,7 +362,7 @@ def breakDownNewEnvInProcess(process, shell):
 @process_task
 def getClass(name, process, shell):
     try:
-        obj = get_env(shell.user_ns)[name]
+        obj = get_value(shell, name)
         obj_type = type(obj)
         return obj_type.__module__ + "." + obj_type.__name__
     except:
@@ -224,13 +371,13 @@ def getClass(name, process, shell):
 
 @process_task
 def convert(name, converter, process, shell):
-    return dill.loads(converter)(get_env(shell.user_ns)[name])
+    return dill.loads(converter)(get_value(shell, name))
 
 
 @process_task
 def getStreamPickle(name, process, shell):
     try:
-        return pickle.dumps(get_env(shell.user_ns)[name])
+        return pickle.dumps(get_value(shell, name))
     except:
         return None
 
@@ -238,7 +385,7 @@ def getStreamPickle(name, process, shell):
 @process_task
 def getStreamDill(name, process, shell):
     try:
-        return dill.dumps(get_env(shell.user_ns)[name])
+        return dill.dumps(get_value(shell, name))
     except:
         return None
 
@@ -248,42 +395,380 @@ class ReprFail:
         self.info = info
 
 
-def getRepresentation(name, process):
-    obj_class = getClass(name, process)
-    converters = tcs_pythonwhat.State.State.root_state.converters
-    if obj_class in converters:
-        repres = convert(name, dill.dumps(converters[obj_class]), process)
-        if errored(repres):
-            return ReprFail("manual conversion failed: {}".format(repres))
-        else:
-            return repres
-    else:
-        # first try to pickle
+class SharedBuffers:
+    """Out-of-band pickle buffers of a value, passed on in a memory mapped file.
+
+    Large buffers, e.g. the data of NumPy arrays and DataFrames, are written to a file
+    in shared memory by the worker. The grading process maps the file and loads the
+    value on top of the mapping, without copying, and removes the file right away.
+    The mapping is released when the value is no longer used,
+    e.g. by ``EqualTest`` after comparing values.
+    """
+
+    threshold = 2 ** 20  # bytes, smaller buffers are sent along with the answer
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    # mapped buffers while collecting them, per context as SCTs run in parallel threads
+    _opened = ContextVar("opened_buffers", default=None)
+
+    def __init__(self, buffers):
+        raws = [buffer.raw() for buffer in buffers]
+        self.sizes = [raw.nbytes for raw in raws]
+        fd, self.path = tempfile.mkstemp(prefix="pythonwhat-", dir=self.directory)
         try:
-            stream = getStreamPickle(name, process)
-            if not errored(stream):
-                return pickle.loads(stream)
-        except:
+            os.ftruncate(fd, sum(self.sizes))
+            with mmap.mmap(fd, sum(self.sizes)) as mapping:
+                offset = 0
+                for raw, size in zip(raws, self.sizes):
+                    mapping[offset : offset + size] = raw
+                    offset += size
+        finally:
+            os.close(fd)
+        self.mapping = None
+
+    @classmethod
+    def share(cls, buffers):
+        """Get the buffers to send along with a pickle stream."""
+        if sum(buffer.raw().nbytes for buffer in buffers) < cls.threshold:
+            # writable, like the mappings of large buffers
+            return [bytearray(buffer.raw()) for buffer in buffers]
+        return cls(buffers)
+
+    def open(self):
+        """Map the buffers into this process."""
+        with open(self.path, "r+b") as f:
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        os.remove(self.path)
+        opened = SharedBuffers._opened.get()
+        if opened is not None:
+            opened.append(self)
+        views = []
+        offset = 0
+        for size in self.sizes:
+            views.append(memoryview(self.mapping)[offset : offset + size])
+            offset += size
+        return views
+
+    def discard(self):
+        """Remove the file, unless the buffers were opened already."""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
             pass
 
-        # if it failed, try to dill
+    def release(self):
+        try:
+            self.mapping.close()
+        except BufferError:
+            pass  # still in use, the mapping is released once it isn't
+
+    @classmethod
+    @contextmanager
+    def collect(cls):
+        """Collect the buffers mapped in this block, to release them afterwards."""
+        opened = []
+        token = cls._opened.set(opened)
+        try:
+            yield opened
+        finally:
+            cls._opened.reset(token)
+
+
+class MissingConverter:
+    """Answer of ``fetchValue`` when the converter for a class isn't registered yet."""
+
+    def __init__(self, class_name):
+        self.class_name = class_name
+
+
+# dill streams of converters and their digests, kept as long as the converter
+converter_streams = WeakKeyDictionary()
+
+
+def get_converter_stream(converter):
+    """Get the digest and dill stream of a converter function."""
+    try:
+        return converter_streams[converter]
+    except (KeyError, TypeError):
+        pass
+    stream = dill.dumps(converter)
+    entry = hashlib.sha1(stream).hexdigest(), stream
+    try:
+        converter_streams[converter] = entry
+    except TypeError:
+        pass  # not weak referenceable
+    return entry
+
+
+@process_task
+def registerConverter(digest, stream, process, shell):
+    get_registry(shell)["converters"][digest] = dill.loads(stream)
+    return True
+
+
+def apply_converter(shell, obj, converters):
+    """Convert a value if there is a converter for its class, see ``fetchValue``.
+
+    Returns ``None`` if there is no converter.
+    """
+    obj_class = type(obj).__module__ + "." + type(obj).__name__
+    if obj_class not in converters:
+        return None
+    converter = get_registry(shell)["converters"].get(converters[obj_class])
+    if converter is None:
+        return MissingConverter(obj_class)
+    try:
+        return "converted", converter(obj)
+    except Exception as e:
+        error = [{"type": "backend-error", "payload": str(e)}]
+        return ReprFail("manual conversion failed: {}".format(error))
+
+
+@process_task
+def fetchValue(name, converters, process, shell):
+    """Get a value as a ``(method, stream)`` pair to load with pickle or dill.
+
+    If there is a converter for the class of the value, it is applied first.
+    ``converters`` maps class names to the digests of registered converters.
+    Returns a ``MissingConverter`` if the converter is not registered in the process yet
+    and a ``ReprFail`` if the value can't be fetched.
+    """
+    try:
+        obj = get_value(shell, name)
+    except Exception:
+        return ReprFail(
+            "dilling inside process failed for None - write manual converter"
+        )
+    conversion = apply_converter(shell, obj, converters)
+    if conversion is not None:
+        return conversion
+
+    # first try to pickle, if it fails, try to dill
+    try:
+        buffers = []
+        stream = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+        return "pickle", (stream, SharedBuffers.share(buffers))
+    except Exception:
+        pass
+    try:
+        return "dill", dill.dumps(obj)
+    except Exception:
+        obj_class = type(obj).__module__ + "." + type(obj).__name__
+        return ReprFail(
+            "dilling inside process failed for %s - write manual converter"
+            % obj_class
+        )
+
+
+class ValuePickler(pickle.Pickler):
+    """Pickler for builtin values only, which are equal if their pickles are."""
+
+    def reducer_override(self, obj):
+        raise PicklingError("%s is not a builtin value" % type(obj).__name__)
+
+
+def fingerprint(obj):
+    """Digest of a value, or ``None`` if it can't be fingerprinted.
+
+    Values with the same fingerprint are equal according to ``Test.is_equal``;
+    values with different fingerprints still have to be compared.
+    """
+    digest = hashlib.sha1()
+    if type(obj) is np.ndarray:
+        if obj.dtype.hasobject:
+            return None
+        digest.update(repr((obj.dtype.str, obj.shape)).encode())
+        digest.update(np.ascontiguousarray(obj).reshape(-1).view(np.uint8))
+    elif type(obj) in (pd.DataFrame, pd.Series):
+        if isinstance(obj, pd.DataFrame):
+            dtypes = list(obj.dtypes)
+            header = list(obj.columns), [repr(dtype) for dtype in dtypes]
+        else:
+            dtypes = [obj.dtype]
+            header = obj.name, repr(obj.dtype)
+        # object and category data are hashed as strings, so e.g. 1 and '1' would match
+        if any(
+            pd.api.types.is_object_dtype(dtype) or isinstance(dtype, pd.CategoricalDtype)
+            for dtype in dtypes + [obj.index.dtype]
+        ):
+            return None
+        header += type(obj.index).__name__, list(obj.index.names), repr(obj.index.dtype)
+        digest.update(pickle.dumps(header))
+        digest.update(pd.util.hash_pandas_object(obj, index=True).to_numpy())
+    else:
+        if isinstance(obj, float) and obj != obj:
+            return None  # nan is not equal to itself
         try:
-            stream = getStreamDill(name, process)
-            if not errored(stream):
-                return dill.loads(stream)
-            return ReprFail(
-                "dilling inside process failed for %s - write manual converter"
-                % obj_class
-            )
+            ValuePickler(SimpleNamespace(write=digest.update), protocol=5).dump(obj)
         except PicklingError:
-            return ReprFail(
-                "undilling of bytestream failed with PicklingError - write manual converter"
-            )
-        except Exception as e:
-            return ReprFail(
-                "undilling of bytestream failed for class %s - write manual converter."
-                "Error: %s - %s" % (obj_class, type(e), e)
-            )
+            return None
+    return digest.hexdigest()
+
+
+@process_task
+def getFingerprintInProcess(name, process, shell):
+    try:
+        return fingerprint(get_value(shell, name))
+    except Exception:
+        return None
+
+
+class RemoteValue:
+    """Stands in for a value that was compared without fetching it from its process.
+
+    Args:
+        res: string representation of the value, from ``taskRunEval``
+        equal: the outcome of the comparison
+        is_str: whether the value is a string
+    """
+
+    def __init__(self, res, equal, is_str=False):
+        self.res = res
+        self.equal = equal
+        self.is_str = is_str
+
+    def __str__(self):
+        # quoted like fetched strings are in feedback
+        return "'{}'".format(self.res) if self.is_str else self.res
+
+    def __eq__(self, other):
+        return self.equal
+
+
+@process_task
+def compareInProcess(name, answer, func_stream, converters, process, shell):
+    """Compare an answer of ``fetchValue`` from another process to a value in this one.
+
+    Returns a tuple of the outcome and whether either value is a string,
+    or a ``ReprFail`` if the answer can't be loaded here.
+    """
+    from tcs_pythonwhat.Test import is_equal
+
+    obj = get_value(shell, name)
+    conversion = apply_converter(shell, obj, converters)
+    if isinstance(conversion, (MissingConverter, ReprFail)):
+        return conversion
+    if conversion is not None:
+        obj = conversion[1]
+
+    method, value = answer
+    buffers = None
+    try:
+        if method == "pickle":
+            stream, buffers = value
+            if isinstance(buffers, SharedBuffers):
+                other = pickle.loads(stream, buffers=buffers.open())
+            else:
+                other = pickle.loads(stream, buffers=buffers)
+        elif method == "dill":
+            other = dill.loads(value)
+        else:
+            other = value
+    except Exception:
+        return ReprFail("loading the value in the other process failed")
+
+    try:
+        func = dill.loads(func_stream) if func_stream is not None else is_equal
+        # arguments in the order of EqualTest, which gets the student value first
+        equal = bool(np.array(func(other, obj)).all())
+        return equal, isinstance(other, str), isinstance(obj, str)
+    finally:
+        del obj, other
+        if isinstance(buffers, SharedBuffers):
+            buffers.release()
+
+
+def get_converter_digests():
+    """Map the classes with a converter to the digests of their converters."""
+    converters = tcs_pythonwhat.State.State.root_state.converters
+    return {
+        obj_class: get_converter_stream(converter)[0]
+        for obj_class, converter in converters.items()
+    }
+
+
+def with_converters(task, process, *args):
+    """Run a task taking converter digests, registering a missing converter first."""
+    digests = get_converter_digests()
+    answer = task(*args, digests, process=process)
+    if isinstance(answer, MissingConverter):
+        converter = tcs_pythonwhat.State.State.root_state.converters[answer.class_name]
+        digest, stream = get_converter_stream(converter)
+        registerConverter(digest, stream, process)
+        answer = task(*args, digests, process=process)
+    return answer
+
+
+def compareValues(name, process, other_name, other_process, func=None):
+    """Compare a value in one process with a value in another, inside the other process.
+
+    Only the first value is transferred, and it isn't loaded in this process.
+    Returns two ``RemoteValue`` objects, or a ``ReprFail`` if
+    the values have to be fetched to compare them here instead.
+    """
+    answer = with_converters(fetchValue, process, name)
+    if isinstance(answer, ReprFail):
+        return answer
+    if errored(answer):
+        return ReprFail("fetching the value failed: {}".format(answer))
+    method, value = answer
+    try:
+        func_stream = dill.dumps(func, recurse=True) if func is not None else None
+        comparison = with_converters(
+            compareInProcess, other_process, other_name, answer, func_stream
+        )
+    finally:
+        if method == "pickle" and isinstance(value[1], SharedBuffers):
+            value[1].discard()  # in case the other process didn't get to open them
+    if isinstance(comparison, (ReprFail, MissingConverter)):
+        return ReprFail("comparing the values in the other process failed")
+    if errored(comparison):
+        raise InstructorError.from_message(
+            "Comparing the values failed: {}".format(comparison)
+        )
+    return comparison
+
+
+def getRepresentation(name, process):
+    answer = with_converters(fetchValue, process, name)
+    return load_representation(answer, name, process)
+
+
+def load_representation(answer, name, process):
+    """Load an answer of ``fetchValue``, falling back to dill if needed."""
+    if isinstance(answer, ReprFail):
+        return answer
+    if errored(answer):
+        return ReprFail("fetching the value failed: {}".format(answer))
+
+    method, value = answer
+    if method == "converted":
+        return value
+    if method == "pickle":
+        stream, buffers = value
+        try:
+            if isinstance(buffers, SharedBuffers):
+                buffers = buffers.open()
+            return pickle.loads(stream, buffers=buffers)
+        except:
+            # e.g. classes that can't be found here, try to dill instead
+            value = getStreamDill(name, process)
+            if errored(value):
+                return ReprFail(
+                    "dilling inside process failed for %s - write manual converter"
+                    % getClass(name, process)
+                )
+
+    try:
+        return dill.loads(value)
+    except PicklingError:
+        return ReprFail(
+            "undilling of bytestream failed with PicklingError - write manual converter"
+        )
+    except Exception as e:
+        return ReprFail(
+            "undilling of bytestream failed for class %s - write manual converter."
+            "Error: %s - %s" % (getClass(name, process), type(e), e)
+        )
 
 
 def errored(el):
@@ -344,6 +829,58 @@ def get_error(f, *args, **kwargs):
     return (res, str(res)) if isinstance(res, Exception) else (None, res)
 
 
+class CodeCache:
+    """LRU cache of compiled code, to compile code that is run repeatedly only once.
+
+    Code is looked up by a digest of the source or the dumped AST, with the mode.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.codes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def compile(self, source, mode):
+        if isinstance(source, str):
+            dump = source
+        else:
+            dump = ast.dump(source, include_attributes=True)
+        key = mode, hashlib.sha1(dump.encode()).hexdigest()
+        try:
+            self.codes.move_to_end(key)
+        except KeyError:
+            self.misses += 1
+            code = compile(source, "<script>", mode)
+            self.codes[key] = code
+            if len(self.codes) > self.maxsize:
+                self.codes.popitem(last=False)
+            return code
+        self.hits += 1
+        return self.codes[key]
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.codes),
+            "maxsize": self.maxsize,
+        }
+
+    def clear(self):
+        self.codes.clear()
+        self.hits = self.misses = 0
+
+
+# compiled code of taskRunEval, per process
+code_cache = CodeCache()
+
+
+@process_task
+def getCodeCacheInfoInProcess(process, shell):
+    return code_cache.info()
+
+
 # General tasks to eval or exec code, with decorated counterparts -------------
 
 
@@ -379,7 +916,7 @@ def taskRunEval(
         expr_code: code to execute instead of focused code
         name: extract value after executing focused expr_code (~post_code)
         copy: copy entire env because our expr_code could have side effects
-        tempname: key for the result when it is added to context, only for v1 sct's
+        tempname: key to store the result under, to later extract it from the process
         call: only used in v1 sct's
 
     Returns:
@@ -403,10 +940,10 @@ def taskRunEval(
 
         # Expression code takes precedence over tree code
         if expr_code:
-            code = expr_code
-            tree = ast.parse(code, mode=mode)
+            tree = ast.parse(expr_code, mode=mode)
+            code = code_cache.compile(expr_code, mode)
         else:  # Compile the tree to Python code
-            code = compile(tree, "<script>", mode)
+            code = code_cache.compile(tree, mode)
 
         # Set up environment --------------------------------------------------
         # Unpack 'container nodes' before checking if a deepcopy is needed
@@ -426,9 +963,17 @@ def taskRunEval(
         ):
             new_env = dict(get_env(shell.user_ns))  # shallow copy of env
         else:
+            # only copy what the code can get at, or everything if it isn't clear
+            names = set()
+            for used in (code, pre_code, name):
+                used_names = utils.get_used_names(used) if used else set()
+                if used_names is None:
+                    names = None
+                    break
+                names |= used_names
             # might raise an error if object refuses pickle interface
             # used by deepcopy to restore class
-            new_env = utils.copy_env(get_env(shell.user_ns))
+            new_env = utils.copy_env(get_env(shell.user_ns), names)
 
         # Apply additional env and context variables
         if env is not None:
@@ -441,7 +986,7 @@ def taskRunEval(
         # Execute code --------------------------------------------------------
         # Run pre_code if specified
         if pre_code:
-            exec(pre_code, new_env)
+            exec(code_cache.compile(pre_code, "exec"), new_env)
 
         if mode == "eval":
             obj = eval(code, new_env)
@@ -452,7 +997,7 @@ def taskRunEval(
         # If name given, get from new_env
         if name:
             try:
-                obj = eval(name, new_env)
+                obj = eval(code_cache.compile(name, "eval"), new_env)
             except NameError:
                 return UndefinedValue()
 
@@ -461,9 +1006,9 @@ def taskRunEval(
         if call is not None:
             obj = obj(*call["args"], **call["kwargs"])
 
-        # Set object as temp variable in original environment, so we can
+        # Store object outside of the namespace, so we can
         # later get its class, etc.., in order to extract it from process
-        get_env(shell.user_ns)[tempname] = obj
+        get_registry(shell)["results"][tempname] = obj
 
         return str(obj)
 
@@ -474,3 +1019,84 @@ def taskRunEval(
 getResultInProcess = get_rep(taskRunEval)
 getOutputInProcess = partial(get_output, taskRunEval)
 getErrorInProcess = partial(get_error, taskRunEval)
+
+
+def getFingerprintedResultInProcess(process, tempname="_evaluation_object_", **kwargs):
+    """Run ``taskRunEval`` and fingerprint the result in a single round trip.
+
+    Returns the result of ``taskRunEval`` and the fingerprint, or ``None``
+    if the expression didn't produce a value to fingerprint.
+    """
+    with TaskCollector(process) as collector:
+        res = taskRunEval.defer(collector, tempname=tempname, **kwargs)
+        digest = getFingerprintInProcess.defer(collector, tempname)
+    res, digest = res.get(), digest.get()
+    if isinstance(res, (UndefinedValue, Exception)) or not isinstance(digest, str):
+        # no new value was stored, or it can't be fingerprinted
+        return res, None
+    return res, digest
+
+
+def getCaseResultsInProcess(
+    test,
+    cases,
+    process,
+    tempname="_evaluation_object_",
+    case_buffers=None,
+    **kwargs
+):
+    """Evaluate an expression for several ``context_vals``, in a single round trip.
+
+    Values are fetched in a single round trip as well.
+
+    Args:
+        test: ``"value"``, ``"output"`` or ``"error"``
+        cases: the ``context_vals`` of every evaluation
+        case_buffers: if specified, a list per case to add the ``SharedBuffers``
+          the values of the case are loaded from to, to release them per case
+        kwargs: arguments for ``taskRunEval``
+
+    Returns:
+        list: the result of every case, like ``get{Result,Output,Error}InProcess`` return it
+    """
+    tempnames = ["%s%d_" % (tempname, i) for i in range(len(cases))]
+    with TaskCollector(process) as collector:
+        if test == "value":
+            answers = [
+                taskRunEval.defer(
+                    collector, context_vals=case, tempname=case_tempname, **kwargs
+                )
+                for case, case_tempname in zip(cases, tempnames)
+            ]
+        else:
+            task = get_output if test == "output" else get_error
+            answers = [
+                task.defer(collector, taskRunEval, context_vals=case, **kwargs)
+                for case in cases
+            ]
+    results = [answer.get() for answer in answers]
+    if test != "value":
+        return results
+
+    digests = get_converter_digests()
+    with TaskCollector(process) as collector:
+        fetched = [
+            None
+            if isinstance(res, (UndefinedValue, Exception))
+            else fetchValue.defer(collector, case_tempname, digests)
+            for res, case_tempname in zip(results, tempnames)
+        ]
+    values = []
+    for i, (res, answer, case_tempname) in enumerate(zip(results, fetched, tempnames)):
+        with SharedBuffers.collect() if case_buffers else nullcontext([]) as opened:
+            if answer is None:
+                values.append((res, str(res)))
+            elif isinstance(answer.get(), MissingConverter):
+                values.append((getRepresentation(case_tempname, process), res))
+            else:
+                values.append(
+                    (load_representation(answer.get(), case_tempname, process), res)
+                )
+        if case_buffers:
+            case_buffers[i].extend(opened)
+    return values
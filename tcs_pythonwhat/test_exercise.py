@@ -1,5 +1,19 @@
-from tcs_pythonwhat.State import State
-from tcs_pythonwhat.local import run_exercise
+import ast
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from functools import partial
+from contextvars import copy_context
+
+from tcs_pythonwhat.State import State, Dispatcher
+from tcs_pythonwhat.local import (
+    DeferredProcess,
+    ResultCache,
+    WorkerPool,
+    Zygote,
+    run_exercise,
+    run_single_process,
+)
 from tcs_pythonwhat.sct_syntax import Ex, get_chains
 from tcs_pythonwhat.utils import check_str, check_process
 from tcs_protowhat.Reporter import Reporter
@@ -18,6 +32,9 @@ def test_exercise(
     ex_type,
     error,
     force_diagnose=False,
+    solution_cache=None,
+    result_cache=None,
+    bundle=None,
 ):
     """
     Point of interaction with the Python backend.
@@ -31,6 +48,14 @@ def test_exercise(
             raw_student_output (str): The output which is given by executing the student's program.
             ex_type (str): The type of the exercise.
             error (tuple): A tuple with some information on possible errors.
+            solution_cache (SolutionCache): If specified and ``solution_process`` is None,
+              the solution process is borrowed from this cache for the duration of the SCT.
+            result_cache (ResultCache): If specified, results of the solution side of checks
+              are taken from and stored in this cache, so checks use the solution process only once.
+            bundle (ExerciseBundle): If specified, the parsed solution code and the results of the
+              solution side of checks are taken from this bundle, see ``compile_exercise``.
+              If ``solution_process`` is None, a solution process is only started (or borrowed from
+              ``solution_cache``) when a check needs a result that isn't in the bundle.
     Returns:
             dict: Returns dict with correct - whether the SCT passed, message - the feedback message and
               tags - the tags belonging to the SCT execution.
@@ -38,8 +63,30 @@ def test_exercise(
 
     reporter = Reporter(errors=[error] if error else [])
 
+    bundle_kwargs = {}
+    deferred = None
+    if bundle is not None:
+        if not bundle.matches(pre_exercise_code, solution_code):
+            raise ValueError("The bundle was compiled for another exercise.")
+        result_cache = bundle
+        bundle_kwargs = dict(
+            solution_ast=bundle.solution_ast,
+            solution_ast_tokens=bundle.solution_ast_tokens,
+            parser_outputs=bundle.parser_outputs,
+        )
+        if solution_process is None:
+            solution_process = deferred = defer_solution_process(
+                pre_exercise_code, solution_code, solution_cache
+            )
+
+    borrowed = solution_process is None and solution_cache is not None
+    if borrowed:
+        solution_process = solution_cache.borrow(pre_exercise_code, solution_code)
+
     try:
-        state = State(
+        return run_sct(
+            sct,
+            reporter,
             student_code=check_str(student_code),
             solution_code=check_str(solution_code),
             pre_exercise_code=check_str(pre_exercise_code),
@@ -47,9 +94,106 @@ def test_exercise(
             solution_process=check_process(solution_process),
             raw_student_output=check_str(raw_student_output),
             force_diagnose=force_diagnose,
-            reporter=reporter,
+            result_cache=result_cache,
+            **bundle_kwargs
+        )
+    finally:
+        if borrowed:
+            solution_cache.release(solution_process)
+        if deferred is not None:
+            deferred.release()
+
+
+def defer_solution_process(pre_exercise_code, solution_code, solution_cache=None):
+    """Solution process that runs the solution code only if a task has to run in it."""
+    if solution_cache is not None:
+        return DeferredProcess(
+            partial(solution_cache.borrow, pre_exercise_code, solution_code),
+            solution_cache.release,
+        )
+    return DeferredProcess(
+        lambda: run_single_process(pre_exercise_code, solution_code)[0],
+        lambda process: process.kill(),
+    )
+
+
+# State.root_state is context-local, so the SCTs of different gradings run in parallel
+sct_executor = ThreadPoolExecutor(thread_name_prefix="pythonwhat-sct")
+
+
+async def test_exercise_async(
+    sct,
+    student_code,
+    solution_code,
+    pre_exercise_code,
+    student_process,
+    solution_process,
+    raw_student_output,
+    ex_type,
+    error,
+    force_diagnose=False,
+    solution_cache=None,
+    result_cache=None,
+    bundle=None,
+    executor=None,
+):
+    """
+    Version of ``test_exercise`` to await in an asyncio event loop.
+
+    A solution process borrowed from ``solution_cache`` is awaited if it has to run the solution code.
+    The SCT runs in its own context on a thread of ``executor``, ``sct_executor`` by default,
+    and occupies that thread for its whole run, including the time it waits on its processes.
+    So at most as many SCTs overlap as the executor has threads, the default size of
+    a ``ThreadPoolExecutor`` for ``sct_executor``; further gradings wait for a free thread.
+    Pass a larger executor to overlap more gradings.
+    Other args and the return value are the same as for ``test_exercise``.
+    """
+    borrowed = (
+        solution_process is None and solution_cache is not None and bundle is None
+    )
+    if borrowed:
+        solution_process = await solution_cache.borrow_async(
+            pre_exercise_code, solution_code
         )
 
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            executor or sct_executor,
+            partial(
+                copy_context().run,
+                test_exercise,
+                sct=sct,
+                student_code=student_code,
+                solution_code=solution_code,
+                pre_exercise_code=pre_exercise_code,
+                student_process=student_process,
+                solution_process=solution_process,
+                raw_student_output=raw_student_output,
+                ex_type=ex_type,
+                error=error,
+                force_diagnose=force_diagnose,
+                solution_cache=solution_cache,
+                result_cache=result_cache,
+                bundle=bundle,
+            ),
+        )
+    finally:
+        if borrowed:
+            solution_cache.release(solution_process)
+
+
+def run_sct(sct, reporter, result_cache=None, parser_outputs=(), **state_kwargs):
+    """Execute an SCT (source or compiled code) on a new root state and build the payload."""
+    try:
+        state = State(reporter=reporter, **state_kwargs)
+        for node, parsers in parser_outputs:
+            state.ast_dispatcher._parser_cache[node] = dict(parsers)
+        if result_cache is not None:
+            state.result_cache = result_cache
+            state.exercise_key = result_cache.get_key(
+                state_kwargs["pre_exercise_code"], state_kwargs["solution_code"]
+            )
+
         State.root_state = state
         tree, sct_cntxt = prep_context()
 
@@ -70,6 +214,195 @@ def test_exercise(
     return reporter.build_final_payload()
 
 
+def test_exercise_batch(
+    sct,
+    solution_code,
+    pre_exercise_code,
+    submissions,
+    force_diagnose=False,
+    workers=2,
+    ordered=True,
+    mode="simple",
+    sol_wd=None,
+    stu_wd=None,
+    limits=None,
+    result_cache=None,
+):
+    """
+    Grade many submissions of the same exercise.
+
+    The SCT is compiled once, the solution code is parsed and executed once
+    and the student code of at most ``workers`` submissions is executed at the same time,
+    in processes taken from a ``WorkerPool``. The SCTs themselves run one at a time.
+    Every submission is graded against its own solution process, forked from a ``Zygote``
+    that ran the solution code, so SCTs can't change the solution process of other submissions.
+    In stub mode the solution code is executed for every submission.
+    Args:
+            sct (str): The solution corectness test as a string of code.
+            solution_code (str): The code which is in the solution.
+            pre_exercise_code (str): The code which is executed pre exercise.
+            submissions (iterable): The code entered by the students, one string per submission.
+            workers (int): The number of student processes that run at the same time.
+            ordered (bool): Whether to yield the results in the order of ``submissions``,
+              or as soon as they are ready.
+            mode (str): The process mode, see ``run_single_process``.
+            sol_wd (str): The working directory of the solution process.
+            stu_wd (str): The working directory of the student processes.
+            limits (TaskLimits): The limits on the tasks of the solution and student processes.
+            result_cache (ResultCache): The cache of solution results, see ``test_exercise``.
+    Yields:
+            tuple: The index of the submission and the dict ``test_exercise`` returns for it.
+    """
+    solution_code = check_str(solution_code)
+    pre_exercise_code = check_str(pre_exercise_code)
+    sct = compile(sct, "<sct>", "exec")
+    try:
+        solution_ast_tokens, solution_ast = Dispatcher().parse(solution_code)
+    except Exception:
+        # let the state report the parsing error
+        solution_ast_tokens, solution_ast = None, None
+
+    def run_student(student_code):
+        student = run_single_process(
+            pre_exercise_code, student_code, mode=mode, pool=pool, wd=stu_wd
+        )
+        if zygote is not None:
+            solution_process = zygote.fork()
+        else:
+            solution_process, _, _ = run_single_process(
+                pre_exercise_code, solution_code, mode=mode, wd=sol_wd
+            )
+        return (solution_process,) + student
+
+    def grade(student_code, future):
+        solution_process, student_process, raw_student_output, error = future.result()
+        try:
+            return run_sct(
+                sct,
+                Reporter(errors=[error] if error else []),
+                student_code=check_str(student_code),
+                solution_code=solution_code,
+                pre_exercise_code=pre_exercise_code,
+                student_process=check_process(student_process),
+                solution_process=check_process(solution_process),
+                raw_student_output=check_str(raw_student_output),
+                force_diagnose=force_diagnose,
+                solution_ast=solution_ast,
+                solution_ast_tokens=solution_ast_tokens,
+                result_cache=result_cache,
+            )
+        finally:
+            if pool is not None:
+                pool.checkin(student_process)
+                solution_process.kill()
+
+    zygote, pool = None, None
+    if mode != "stub":
+        zygote = Zygote(pre_exercise_code, mode, sol_wd, limits, solution_code)
+        pool = WorkerPool(size=workers, mode=mode, limits=limits)
+    # stub processes change the working directory of this process,
+    # so they are not set up while an SCT runs
+    window = workers if pool is not None else 1
+    executor = ThreadPoolExecutor(max_workers=window)
+    pending = {}  # future -> (index, student code), at most window in flight
+    submissions = enumerate(submissions)
+
+    def submit_next():
+        for index, student_code in submissions:
+            future = executor.submit(run_student, student_code)
+            pending[future] = (index, student_code)
+            return True
+        return False
+
+    try:
+        while len(pending) < window and submit_next():
+            pass
+        while pending:
+            if ordered:
+                # dicts keep insertion order, which is the submission order
+                done = [next(iter(pending))]
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, student_code = pending.pop(future)
+                result = grade(student_code, future)
+                submit_next()
+                yield index, result
+    finally:
+        executor.shutdown(wait=True)
+        for future in pending:
+            if future.exception() is None and pool is not None:
+                solution_process, student_process = future.result()[:2]
+                pool.discard(student_process)
+                solution_process.kill()
+        if pool is not None:
+            pool.close()
+            zygote.kill()
+
+
+def compile_exercise(sct, solution_code, pre_exercise_code, path, **process_kwargs):
+    """
+    Precompute everything the solution side of an SCT contributes to a grading.
+
+    The SCT is run once on the solution code as submission, recording the parsed solution code,
+    the parser outputs for it and the results of the solution side of all checks in a file.
+    Load the file with ``ExerciseBundle`` and pass it to ``test_exercise`` as ``bundle``,
+    so gradings only run the student process.
+    Args:
+            sct (str): The solution corectness test as a string of code.
+            solution_code (str): The code which is in the solution.
+            pre_exercise_code (str): The code which is executed pre exercise.
+            path (str): The file to write the bundle to.
+            process_kwargs: Passed on to ``run_exercise``.
+    Returns:
+            dict: The result of the SCT for the solution code, as returned by ``test_exercise``.
+              Checks after a failing check are not recorded.
+    """
+    solution_code = check_str(solution_code)
+    pre_exercise_code = check_str(pre_exercise_code)
+    solution_ast_tokens, solution_ast = Dispatcher().parse(solution_code)
+    result_cache = ResultCache(max_size=sys.maxsize, max_memory=sys.maxsize)
+
+    solution_process, student_process, raw_student_output, error = run_exercise(
+        pre_exercise_code, solution_code, solution_code, **process_kwargs
+    )
+    try:
+        result = run_sct(
+            sct,
+            Reporter(errors=[error] if error else []),
+            student_code=solution_code,
+            solution_code=solution_code,
+            pre_exercise_code=pre_exercise_code,
+            student_process=check_process(student_process),
+            solution_process=check_process(solution_process),
+            raw_student_output=check_str(raw_student_output),
+            solution_ast=solution_ast,
+            solution_ast_tokens=solution_ast_tokens,
+            result_cache=result_cache,
+        )
+    finally:
+        if process_kwargs.get("mode") != "stub":
+            solution_process.kill()
+            student_process.kill()
+
+    # parser outputs for the solution code, stored with the nodes they refer to
+    parser_cache = State.root_state.ast_dispatcher._parser_cache
+    parser_outputs = [
+        (node, parser_cache[node])
+        for node in ast.walk(solution_ast)
+        if node in parser_cache
+    ]
+    result_cache.save(
+        path,
+        pre_exercise_code=pre_exercise_code,
+        solution_code=solution_code,
+        solution_ast_tokens=solution_ast_tokens,
+        solution_ast=solution_ast,
+        parser_outputs=parser_outputs,
+    )
+    return result
+
+
 # TODO: consistent success_msg
 def success_msg(message):
     """
@@ -1,4 +1,5 @@
-from types import ModuleType
+from types import CodeType, ModuleType
+from functools import lru_cache
 import copy
 import os
 
@@ -19,24 +20,55 @@ def has_newline(text):
     return "\n" in text
 
 
-def copy_env(env):
+def copy_env(env, names=None):
+    """Deep copy the mutable variables in an environment.
+
+    If ``names`` is given, only the variables with these names are copied,
+    see ``get_used_names``.
+    """
     mutableTypes = (tuple, list, dict)
     # One list comprehension to filter list. Might need some cleaning, but it
     # works
     ipy_ignore = ["In", "Out", "get_ipython", "quit", "exit"]
+    keys = env.keys() if names is None else env.keys() & names
     update_env = {
-        key: copy.deepcopy(value)
-        for key, value in env.items()
+        key: copy.deepcopy(env[key])
+        for key in keys
         if not any(
-            (key.startswith("_"), isinstance(value, ModuleType), key in ipy_ignore)
+            (key.startswith("_"), isinstance(env[key], ModuleType), key in ipy_ignore)
         )
-        and isinstance(value, mutableTypes)
+        and isinstance(env[key], mutableTypes)
     }
     updated_env = dict(env)
     updated_env.update(update_env)
     return updated_env
 
 
+# names through which code can get at its whole namespace
+DYNAMIC_NAMES = {"globals", "locals", "vars", "exec", "eval"}
+
+
+@lru_cache(maxsize=256)
+def get_used_names(code):
+    """Get the names code may look up in its namespace, including in nested code.
+
+    Attribute names are included as well, so this may be a few more than needed.
+    Returns ``None`` if the code may get at any name, e.g. through ``globals()``.
+    """
+    if not isinstance(code, CodeType):
+        code = compile(code, "<script>", "exec")
+    names = set(code.co_names)
+    if names & DYNAMIC_NAMES:
+        return None
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            nested = get_used_names(const)
+            if nested is None:
+                return None
+            names |= nested
+    return frozenset(names)
+
+
 def first_lower(s):
     return s[:1].lower() + s[1:] if s else ""
 
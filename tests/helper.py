@@ -11,6 +11,7 @@ from protowhat.sct_syntax import Chain
 from pythonwhat.test_exercise import test_exercise
 import pytest
 import tempfile
+from pathlib import Path
 
 
 test_data = defaultdict(list)
@@ -24,6 +25,9 @@ def capture_test_data(f):
         data = kwargs.copy()
         del data["student_process"]
         del data["solution_process"]
+        data.pop("solution_cache", None)
+        data.pop("result_cache", None)
+        data.pop("bundle", None)
         data["result"] = result
 
         context = "other"
@@ -50,6 +54,33 @@ def in_temp_dir():
             yield d
 
 
+def record_interval(name, names, timeout=10):
+    """Code recording when it starts and ends, it waits for all ``names`` to have started.
+
+    It stops waiting after ``timeout`` seconds, so the intervals don't overlap then.
+    """
+    return (
+        "import os, time\n"
+        # take the time before the file exists, for the others to wait on
+        "started = time.time()\n"
+        "open('{0}.start', 'w').write(repr(started))\n"
+        "deadline = time.time() + {2!r}\n"
+        "while time.time() < deadline and not all(\n"
+        "    os.path.exists(name + '.start') for name in {1!r}\n"
+        "):\n"
+        "    time.sleep(0.01)\n"
+        "open('{0}.end', 'w').write(repr(time.time()))\n"
+    ).format(name, list(names), timeout)
+
+
+def intervals_overlap(names):
+    intervals = [
+        [float(Path(name + ext).read_text()) for ext in [".start", ".end"]]
+        for name in names
+    ]
+    return max(start for start, _ in intervals) <= min(end for _, end in intervals)
+
+
 def run(data, run_code=True):
 
     pec = data.get("DC_PEC", "")
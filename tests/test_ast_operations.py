@@ -1,5 +1,16 @@
+import ast
+from collections.abc import Mapping
+
 import pytest
 from pythonwhat.State import Dispatcher
+from pythonwhat.parsing import (
+    ForParser,
+    FunctionParser,
+    IfParser,
+    StatementFilter,
+    ObjectAccessParser,
+    parser_dict,
+)
 
 
 @pytest.mark.parametrize(
@@ -35,3 +46,78 @@ from pythonwhat.State import Dispatcher
 )
 def test_parses_without_error(script):
     Dispatcher().parse(script)
+
+
+FILTERED_CODE = """
+import numpy as np
+from math import pi as PI
+x = np.array([1, 2])
+x += 1
+y = [i * 2 for i in x if i > 1]
+z = {i: i for i in x}
+g = sum(i for i in x)
+f = lambda a, b=1: a + b
+print(np.mean(x), round(PI, 2))
+x.mean().round()
+x
+if x[0] > 1:
+    a = 1
+elif x[0]:
+    a = 2
+else:
+    a = 3
+b = 1 if a else 2
+while a < 10:
+    a += 1
+for i, j in enumerate(x):
+    print(i)
+with open("f") as f, open("g") as g:
+    print(f.read())
+try:
+    c = 1 / 0
+except (ZeroDivisionError, TypeError) as e:
+    pass
+except Exception:
+    pass
+finally:
+    d = 2
+def func(a, b=1, *args, c=2, **kwargs):
+    return a
+class Point(object):
+    pass
+"""
+
+
+def normalize(out):
+    if isinstance(out, ast.AST):
+        return ast.dump(out, include_attributes=True)
+    if isinstance(out, Mapping):
+        return {k: normalize(v) for k, v in out.items()}
+    if isinstance(out, (list, tuple)):
+        return [normalize(el) for el in out]
+    if isinstance(out, (str, int, bool)) or out is None:
+        return out
+    return type(out).__name__
+
+
+@pytest.mark.parametrize("name", [*parser_dict, "mappings", "oa_mappings"])
+def test_statement_filter_matches_visit(name):
+    dispatcher = Dispatcher()
+    _, tree = dispatcher.parse(FILTERED_CODE)
+    Parser, attr = {
+        "mappings": (FunctionParser, "mappings"),
+        "oa_mappings": (ObjectAccessParser, "mappings"),
+    }.get(name, (parser_dict.get(name), "out"))
+    parser = Parser()
+    if attr == "out" and Parser in [FunctionParser, ObjectAccessParser]:
+        parser.mappings = dispatcher.context_mappings.copy()
+    parser.visit(tree)
+    assert normalize(dispatcher.find(name, tree)) == normalize(getattr(parser, attr))
+
+
+def test_statement_filter_selects_relevant_lines():
+    _, tree = Dispatcher().parse(FILTERED_CODE)
+    statements = StatementFilter(tree)
+    for Parser, node_type in [(IfParser, ast.If), (ForParser, ast.For)]:
+        lines = statements.get_lines(Parser())
+        assert [type(line) for line in lines] == [node_type]
@@ -1,5 +1,7 @@
 import pytest
 import tests.helper as helper
+from pythonwhat.tasks import ReprFail, getRepresentation
+from pythonwhat.test_exercise import setup_state
 
 
 @pytest.mark.slow
@@ -60,3 +62,28 @@ def test_hdf5():
     }
     sct_payload = helper.run(data)
     assert sct_payload["correct"]
+
+
+def count_converters(shell):
+    return len(shell.pythonwhat_registry["converters"])
+
+
+def test_converter_registered_in_process():
+    chain = setup_state("x = {'b': 1, 'a': 2}.keys()\ny = [1]", "")
+    process = chain._state.student_process
+    assert getRepresentation("y", process) == [1]
+    assert process.executeTask(count_converters) == 0
+    for _ in range(2):
+        assert getRepresentation("x", process) == ["a", "b"]
+        assert process.executeTask(count_converters) == 1
+    assert isinstance(getRepresentation("z", process), ReprFail)
+
+
+@pytest.mark.parametrize("mode", ["stub", "simple"])
+def test_unpicklable_value(mode):
+    chain = setup_state("x = (i for i in range(3))", "", mode=mode)
+    answer = getRepresentation("x", chain._state.student_process)
+    assert isinstance(answer, ReprFail)
+    assert answer.info == (
+        "dilling inside process failed for builtins.generator - write manual converter"
+    )
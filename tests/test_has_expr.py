@@ -1,6 +1,12 @@
+import os
+import tempfile
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
 import pytest
 from pythonwhat.test_exercise import setup_state
-from protowhat.failure import InstructorError
+from protowhat.failure import InstructorError, TestFail as TF
 import tests.helper as helper
 
 
@@ -42,14 +48,17 @@ b = NoPickle()
         s.check_object("a").has_equal_value(name="a")
     with helper.verify_sct(True):
         s.has_equal_value(expr_code="a")
-    with pytest.raises(InstructorError):
+    # only the names that are used are copied
+    with helper.verify_sct(True):
         s.has_equal_value(expr_code="a", name="a")
-    with pytest.raises(InstructorError):
+    with helper.verify_sct(True):
         s.has_equal_value(expr_code="print(a)")
-    with pytest.raises(InstructorError):
+    with helper.verify_sct(True):
         s.has_equal_value(expr_code="print(a)", name="a")
     with pytest.raises(InstructorError):
-        s.has_equal_value(expr_code="print(a)")
+        s.has_equal_value(expr_code="print(b)")
+    with pytest.raises(InstructorError):
+        s.has_equal_value(expr_code="print(globals()['a'])")
 
 
 @pytest.mark.parametrize(
@@ -104,6 +113,22 @@ def test_copy_functionality(copy, passes):
         )
 
 
+@pytest.mark.parametrize(
+    "expr_code, pre_code",
+    [
+        ("a[0] = 3", None),
+        ("globals()['a'][0] = 3", None),
+        ("(lambda: a.append(3))()", None),
+        ("f()", "def f(): a[0] = 3"),
+        ("b.append(3)", "b = a"),
+    ],
+)
+def test_copy_only_used_names(expr_code, pre_code):
+    s = setup_state("a = [1]; c = [1]", "a = [1]; c = [1]")
+    s.has_equal_value(expr_code=expr_code, pre_code=pre_code, name="c")
+    s.has_equal_value(expr_code="a", name="a", override=[1])
+
+
 @pytest.mark.parametrize("tol, passes", [(0.001, True), (0.0001, False)])
 def test_test_custom_equality_func(tol, passes):
     s = setup_state("a = [1.011]", "a = [1.01]")
@@ -127,3 +152,234 @@ def test_has_expr_override_pass_2():
     sol = "x = [1, 2, 5]"
     s = setup_state(stu_code=stu, sol_code=sol)
     helper.passes(s.check_object("x").has_equal_value(override=[1, 2, 3]))
+
+
+def test_has_equal_value_shared_buffers():
+    from pythonwhat.tasks import SharedBuffers
+
+    # the dtypes differ, so the fingerprints don't match and the values are fetched
+    code = (
+        "import numpy as np\nimport pandas as pd\n"
+        "x = np.arange(300000, dtype='{}')\ndf = pd.DataFrame({{'x': x}})"
+    )
+    mapped = []
+    open_buffers = SharedBuffers.open
+
+    def open_and_track(self):
+        mapped.append(self)
+        return open_buffers(self)
+
+    with helper.in_temp_dir():
+        chain = setup_state(code.format("int32"), code.format("int64"))
+        with patch.object(SharedBuffers, "open", open_and_track):
+            chain.check_object("x").has_equal_value()
+            with pytest.raises(TF):
+                chain.check_object("df").has_equal_value()
+            with pytest.raises(TF):
+                chain.has_equal_value(expr_code="x[:-1]", override=np.arange(299999) + 1)
+    assert len(mapped) == 5
+    assert all(buffers.mapping.closed for buffers in mapped)
+    directory = SharedBuffers.directory or tempfile.gettempdir()
+    assert not any(path.startswith("pythonwhat-") for path in os.listdir(directory))
+
+
+@pytest.mark.parametrize("size", [10, 300000])
+def test_fetched_arrays_are_writable(size):
+    from pythonwhat.tasks import getRepresentation
+
+    with helper.in_temp_dir():
+        chain = setup_state("import numpy as np\nx = np.arange(%d)" % size)
+        x = getRepresentation("x", chain._state.student_process)
+        assert x.flags.writeable
+        x[0] = 1
+        del x
+
+
+def test_shared_buffers_collected_per_context():
+    import pickle
+    import threading
+    from pythonwhat.tasks import SharedBuffers
+
+    def share():
+        return SharedBuffers([pickle.PickleBuffer(bytearray(b"abc"))])
+
+    a_in, b_in, a_out = threading.Event(), threading.Event(), threading.Event()
+    collected = {}
+
+    def first():
+        with SharedBuffers.collect() as opened:
+            collected["a"] = opened
+            a_in.set()
+            b_in.wait()
+        a_out.set()
+
+    def second():
+        a_in.wait()
+        with SharedBuffers.collect() as opened:
+            collected["b"] = opened
+            b_in.set()
+            a_out.wait()
+            buffers = share()
+            buffers.open()
+        buffers.release()
+
+    threads = [threading.Thread(target=first), threading.Thread(target=second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    outside = share()
+    outside.open()
+    outside.release()
+    assert collected["a"] == []
+    assert len(collected["b"]) == 1
+
+
+@pytest.mark.parametrize(
+    "sol, stu, fetched, passes",
+    [
+        ("np.arange(10.0)", "np.arange(10.0)", False, True),
+        ("np.arange(10.0)", "np.arange(10)", True, True),
+        ("pd.DataFrame({'a': [1.0]})", "pd.DataFrame({'a': [1.0]})", False, True),
+        ("pd.DataFrame({'a': [1.0]})", "pd.DataFrame({'b': [1.0]})", True, False),
+        ("pd.Series([1, 2], name='a')", "pd.Series([1, 2], name='a')", False, True),
+        ("[1.0, float('nan'), {'a': 'b'}]", "[1.0, float('nan'), {'a': 'b'}]", False, True),
+        ("[1.0, float('nan'), {'a': 'b'}]", "[1, float('nan'), {'a': 'b'}]", True, True),
+        ("float('nan')", "float('nan')", True, False),
+        (
+            "pd.Series(pd.Categorical(['a'], categories=['a', 'b']))",
+            "pd.Series(pd.Categorical(['a'], categories=['a', 'c']))",
+            True,
+            False,
+        ),
+        (
+            "pd.Series(pd.Categorical(['a'], ordered=True))",
+            "pd.Series(pd.Categorical(['a'], ordered=False))",
+            True,
+            False,
+        ),
+        ("pd.Series(['a'])", "pd.Series([b'a'])", True, False),
+        (
+            "pd.Series([1.0], index=pd.Index([1], dtype=object))",
+            "pd.Series([1.0], index=pd.Index(['1'], dtype=object))",
+            True,
+            False,
+        ),
+    ],
+)
+def test_has_equal_value_fingerprints(sol, stu, fetched, passes):
+    from pythonwhat.checks import has_funcs
+
+    code = "import numpy as np\nimport pandas as pd\nx = {}"
+    chain = setup_state(code.format(stu), code.format(sol))
+    fetch = has_funcs.getResultFromProcess
+    with patch.object(has_funcs, "getResultFromProcess", wraps=fetch) as fetch_mock:
+        with helper.verify_sct(passes):
+            chain.check_object("x").has_equal_value()
+    assert fetch_mock.called == fetched
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        float("nan"),
+        np.array([object()]),
+        [object()],
+        TF,
+        pd.Series([b"a"]),
+        pd.DataFrame({"a": pd.Categorical(["a"])}),
+        pd.Series([1.0], index=pd.Index([1], dtype=object)),
+    ],
+)
+def test_fingerprint_unsupported(value):
+    from pythonwhat.tasks import fingerprint
+
+    assert fingerprint(value) is None
+
+
+def test_fingerprint_distinguishes_types():
+    from pythonwhat.tasks import fingerprint
+
+    assert fingerprint(1) != fingerprint(True)
+    assert fingerprint(np.zeros(2)) != fingerprint(np.zeros(2, dtype=int))
+    assert fingerprint(np.zeros(4)) != fingerprint(np.zeros((2, 2)))
+    assert fingerprint(np.arange(6)[::2]) == fingerprint(np.array([0, 2, 4]))
+
+
+@pytest.mark.parametrize(
+    "stu, func, passes",
+    [
+        ("np.arange(300000, dtype='int32')", None, True),
+        ("np.arange(300000) + 1", None, False),
+        ("np.arange(300000) + 1", "lambda x, y: len(x) == len(y)", True),
+        ("'abc'", None, False),
+    ],
+)
+def test_has_equal_value_compare_in_process(stu, func, passes):
+    from pythonwhat import tasks
+
+    code = "import numpy as np\nx = {}"
+    sol = "np.arange(300000)" if stu.startswith("np") else "'abd'"
+    sct = "Ex().check_object('x').has_equal_value(compare_in_process=True{})".format(
+        "" if func is None else ", func=" + func
+    )
+    with patch.object(tasks, "getRepresentation") as fetch_mock:
+        output = helper.run(
+            {
+                "DC_SOLUTION": code.format(sol),
+                "DC_CODE": code.format(stu),
+                "DC_SCT": sct,
+            }
+        )
+    assert not fetch_mock.called
+    assert output["correct"] == passes
+    if stu == "'abc'":
+        assert "'abd'" in output["message"] and "'abc'" in output["message"]
+
+
+@pytest.mark.parametrize(
+    "cases, passes", [([[0], [1]], True), ([[0], [1], [2]], False)]
+)
+@pytest.mark.parametrize("test", ["value", "output"])
+def test_has_expr_context_cases(cases, passes, test):
+    sol = "for i in range(3):\n    x = i * 2\n    print(x)"
+    stu = "for j in range(3):\n    x = j * 2 if j < 2 else 0\n    print(x)"
+    body = setup_state(stu, sol).check_for_loop().check_body()
+    with helper.verify_sct(passes):
+        if test == "value":
+            body.has_equal_value(name="x", context_cases=cases)
+        else:
+            body.has_equal_output(context_cases=cases)
+
+
+def test_has_expr_context_cases_release_buffers():
+    from pythonwhat.tasks import SharedBuffers
+
+    sol = "import numpy as np\nfor i in range(3):\n    x = np.arange(300000) * i"
+    released = []
+    release = SharedBuffers.release
+
+    def release_and_track(self):
+        release(self)
+        released.append(self.mapping.closed)
+
+    with helper.in_temp_dir():
+        body = setup_state(sol, sol).check_for_loop().check_body()
+        with patch.object(SharedBuffers, "release", release_and_track):
+            body.has_equal_value(name="x", context_cases=[[0], [1], [2]])
+    # the buffers of both sides are released right after comparing their case
+    assert released == [True] * 6
+
+
+def test_has_expr_context_cases_round_trips():
+    sol = "for i in range(3):\n    x = [i] * 2"
+    body = setup_state(sol, sol).check_for_loop().check_body()
+    round_trips = []
+    for process in [body._state.solution_process, body._state.student_process]:
+        execute_task = process.executeTask
+        process.executeTask = lambda task, f=execute_task: round_trips.append(
+            task
+        ) or f(task)
+    body.has_equal_value(name="x", context_cases=[[i] for i in range(10)])
+    # evaluating and fetching the values for all cases, on both sides
+    assert len(round_trips) == 4
@@ -1,11 +1,42 @@
 import os
+import sys
+import subprocess
+import asyncio
 from pathlib import Path
 
 import pytest
 
-from pythonwhat.local import ChDir
+from pythonwhat.local import (
+    Channel,
+    ChDir,
+    DeferredProcess,
+    ResultCache,
+    SolutionCache,
+    WorkerPool,
+    TaskChangeDir,
+    TaskCaptureOutput,
+    TaskLimits,
+    TaskOutOfMemory,
+    TaskTimeout,
+    get_zygote,
+    kill_zygotes,
+    run_exercise,
+    run_exercise_async,
+    run_single_process,
+)
+from pythonwhat.tasks import (
+    TaskCollector,
+    getColumnsInProcess,
+    isDefinedInProcess,
+)
+from protowhat.failure import TestFail as TF
 from pythonwhat.test_exercise import setup_state
-from tests.helper import verify_sct, in_temp_dir
+from tests.helper import (
+    verify_sct,
+    in_temp_dir,
+    record_interval,
+    intervals_overlap,
+)
 
 modify_sys = (
     """
@@ -190,3 +221,395 @@ def test_run_custom_solution_dir():
 
         child.run(file_dir, solution_dir=custom_solution_location).check_object("c")
         child.run(solution_dir=custom_solution_location).check_object("c")
+
+
+def test_worker_pool_forks_fresh_workers():
+    with WorkerPool(size=1) as pool:
+        sol_process, stu_process, _, _ = run_exercise(
+            "", "x = 1", "x = 1", pool=pool
+        )
+        pool.checkin(sol_process)
+        pool.checkin(stu_process)
+        assert not sol_process.is_alive()
+        assert not stu_process.is_alive()
+        assert len(pool) == 1
+
+        process, _, _ = run_single_process("", "y = 2", pool=pool)
+        assert process not in [sol_process, stu_process]
+        assert not isDefinedInProcess("x", process)
+        assert isDefinedInProcess("y", process)
+        pool.checkin(process)
+
+
+def test_worker_pool_monkeypatch_isolation():
+    with WorkerPool(size=1) as pool:
+        process, _, _ = run_single_process(
+            "", "import builtins\nbuiltins.sum = lambda *a: 42", pool=pool
+        )
+        pool.checkin(process)
+
+        for _ in range(2):
+            process, _, _ = run_single_process(
+                "", "if sum([1, 2]) == 3: ok = True", pool=pool
+            )
+            assert isDefinedInProcess("ok", process)
+            pool.checkin(process)
+
+
+def test_worker_pool_idle_timeout():
+    with WorkerPool(size=2, idle_timeout=0) as pool:
+        pool.prune()
+        assert len(pool) == 0
+
+
+def test_worker_pool_setup_state():
+    with WorkerPool(size=2) as pool, in_temp_dir():
+        chain = setup_state("x = 1", "x = 1", pec="import os", pool=pool)
+        chain.check_object("x").has_equal_value()
+        for process in [chain._state.solution_process, chain._state.student_process]:
+            process.executeTask(TaskChangeDir("/"))
+            pool.checkin(process)
+
+        chain = setup_state("print(os.getcwd())", "", pec="import os", pool=pool)
+        chain.has_output(os.getcwd(), pattern=False)
+
+
+def test_zygote_runs_pec_once():
+    pec = "with open('pec_runs', 'a') as f: f.write('run')\nimport math"
+    with in_temp_dir():
+        for _ in range(2):
+            chain = setup_state(
+                "x = math.sqrt(4)", "x = math.sqrt(4)", pec=pec, zygote=True
+            )
+            chain.check_object("x").has_equal_value()
+            assert chain._state.has_different_processes()
+
+        with open("pec_runs") as f:
+            assert f.read() == "run"
+        kill_zygotes()
+
+
+def test_zygote_forked_workers_are_isolated():
+    with in_temp_dir():
+        zygote = get_zygote("x = [1]")
+        first, second = zygote.fork(), zygote.fork()
+        first.executeTask(TaskCaptureOutput("x.append(2)"))
+        assert second.executeTask(TaskCaptureOutput("print(x)")) == ("[1]\n", None)
+        first.kill()
+        assert not first.is_alive()
+        assert second.is_alive()
+        kill_zygotes()
+
+
+def test_zygote_keys_limits_by_value(monkeypatch):
+    import pythonwhat.local
+
+    monkeypatch.setattr(pythonwhat.local, "MAX_ZYGOTES", 1)
+    with in_temp_dir():
+        zygote = get_zygote("x = 1", limits=TaskLimits(timeout=10))
+        assert get_zygote("x = 1", limits=TaskLimits(timeout=10)) is zygote
+
+        other = get_zygote("x = 1", limits=TaskLimits(timeout=20))
+        assert other is not zygote
+        assert not zygote.is_alive()
+        assert other.is_alive()
+        kill_zygotes()
+
+
+def test_run_exercise_concurrently():
+    names = ["sol", "stu"]
+    with in_temp_dir():
+        run_exercise("", *[record_interval(name, names) for name in names])
+        assert intervals_overlap(names)
+
+
+def test_run_exercise_async():
+    # the eight processes start one after another, which is slow on a busy machine
+    names = ["%s%d" % (side, i) for i in range(4) for side in ["sol", "stu"]]
+
+    async def run_exercises():
+        runs = [
+            run_exercise_async(
+                "",
+                record_interval(names[2 * i], names, timeout=120),
+                record_interval(names[2 * i + 1], names, timeout=120) + "x = 4",
+            )
+            for i in range(4)
+        ]
+        return await asyncio.gather(*runs)
+
+    with in_temp_dir():
+        results = asyncio.run(run_exercises())
+        assert intervals_overlap(names)
+    for sol_process, stu_process, _, error in results:
+        assert error is None
+        assert not asyncio.run(isDefinedInProcess.run_async("x", sol_process))
+        assert asyncio.run(isDefinedInProcess.run_async("x", stu_process))
+
+
+def test_run_exercise_working_dirs():
+    code = "import os; wd = os.getcwd()"
+    with in_temp_dir() as d:
+        os.makedirs("sol")
+        os.makedirs("stu")
+        sol_wd, stu_wd = Path(d, "sol"), Path(d, "stu")
+        sol_process, stu_process, _, _ = run_exercise(
+            "", code, code, sol_wd=sol_wd, stu_wd=stu_wd
+        )
+        assert os.getcwd() == d
+        for process, wd in [(sol_process, sol_wd), (stu_process, stu_wd)]:
+            output, _ = process.executeTask(TaskCaptureOutput("print(wd)"))
+            assert output.strip() == os.path.realpath(str(wd))
+
+
+def test_solution_cache_forks_processes():
+    cache = SolutionCache(max_size=1)
+    with in_temp_dir():
+        sol_process, stu_process, _, _ = run_exercise(
+            "", "x = [1]", "x = [1]", solution_cache=cache
+        )
+        cache.release(sol_process)
+        assert not sol_process.is_alive()
+        assert len(cache) == 1
+
+        process = cache.borrow("", "x = [1]")
+        assert process is not sol_process
+        assert isDefinedInProcess("x", process)
+        other = cache.borrow("", "x = [2]")
+        cache.release(process)
+        cache.release(other)
+        assert len(cache) == 1
+        assert not process.is_alive()
+        stu_process.kill()
+        cache.clear()
+
+
+@pytest.mark.parametrize(
+    "code, expr_code",
+    [
+        ("x = [1]\ndef f():\n    x.append(2)\n    return len(x)", "f()"),
+        ("import numpy as np\nx = np.array([1, 2])", "np.add(x, 1, out=x)"),
+    ],
+)
+def test_solution_cache_isolates_gradings(code, expr_code):
+    cache = SolutionCache()
+    with in_temp_dir():
+        for _ in range(3):
+            chain = setup_state(code, code, pec="", solution_cache=cache)
+            chain.has_equal_value(expr_code=expr_code)
+            cache.release(chain._state.solution_process)
+            chain._state.student_process.kill()
+        cache.clear()
+
+
+def test_solution_cache_memory_cap():
+    cache = SolutionCache(max_memory=1)
+    with in_temp_dir():
+        process = cache.borrow("", "x = 1")
+        assert len(cache) == 0
+        assert isDefinedInProcess("x", process)
+        cache.release(process)
+        assert not process.is_alive()
+
+
+def test_result_cache():
+    cache = ResultCache(max_size=2)
+    keys = [cache.get_key("exercise", i) for i in range(3)]
+    assert keys[0] == cache.get_key("exercise", 0)
+    assert cache.get_key(lambda: None) is None
+    result = [1, 2]
+    cache.put(keys[0], result)
+    result.append(3)
+    assert cache.get(keys[0]) == [1, 2]
+    cache.put(keys[1], "b")
+    cache.get(keys[0])
+    cache.put(keys[2], "c")
+    assert len(cache) == 2
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) == "c"
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_result_cache_key_of_sets():
+    code = (
+        "from tcs_pythonwhat.local import ResultCache\n"
+        "print(ResultCache.get_key({'a', 'b', 'c', frozenset({'x', 'y'})}))"
+    )
+    keys = {
+        subprocess.run(
+            [sys.executable, "-c", code],
+            env=dict(os.environ, PYTHONHASHSEED=str(seed)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        for seed in range(3)
+    }
+    assert len(keys) == 1
+    assert ResultCache.get_key({"a"}) != ResultCache.get_key(frozenset({"a"}))
+
+
+def test_deferred_process():
+    stopped = []
+    with in_temp_dir():
+        process = DeferredProcess(
+            lambda: run_single_process("", "x = 1")[0], stopped.append
+        )
+        assert not process.concurrent_tasks
+        assert not process.started
+        assert isDefinedInProcess("x", process)
+        assert process.started
+        started = process.process
+        process.release()
+        assert stopped == [started]
+        started.kill()
+
+
+def test_result_cache_memory_cap(tmp_path):
+    cache = ResultCache(max_memory=1, directory=str(tmp_path))
+    key = cache.get_key("exercise")
+    cache.put(key, "result")
+    assert len(cache) == 0
+    assert cache.get(key) == "result"
+
+
+@pytest.mark.parametrize(
+    "limits, limit",
+    [
+        (TaskLimits(timeout=0.3), "timeout"),
+        (TaskLimits(cpu_time=0.3), "cpu_time"),
+        (TaskLimits(rss=200 * 2 ** 20), "rss"),
+    ],
+)
+def test_task_limits_stop_worker(limits, limit):
+    code = "x = [1]\nwhile True: x.append(x[-1] + 1)"
+    process, _, error = run_single_process("", code, limits=limits)
+    assert error.startswith("Task exceeded the %s limit" % limit)
+    assert process.limit_exceeded.limit == limit
+    process.wait_exit(timeout=1)
+    assert not process.is_alive()
+    assert isinstance(
+        process.executeTask(TaskCaptureOutput("print(1)")), TaskTimeout
+    ) == (limit != "rss")
+    process.kill()
+
+
+def test_task_memory_limit():
+    with open("/proc/self/statm") as f:
+        size = int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    limits = TaskLimits(memory=size + 200 * 2 ** 20)
+    process, _, error = run_single_process("", "x = bytearray(2 ** 30)", limits=limits)
+    assert isinstance(process.limit_exceeded, TaskOutOfMemory)
+    assert error == str(process.limit_exceeded)
+    process.kill()
+
+    # allocations within the limit and other errors are answered as usual
+    process, _, error = run_single_process(
+        "", "x = bytearray(2 ** 20)\ny = 1 / 0", limits=limits
+    )
+    assert error == "division by zero"
+    assert process.limit_exceeded is None
+    process.kill()
+
+
+def test_task_limits_in_has_equal_value():
+    limits = TaskLimits(timeout=0.3)
+    with WorkerPool(size=1, limits=limits) as pool:
+        chain = setup_state(
+            "def f():\n    while True: pass", "def f(): return 1", pool=pool
+        )
+        with pytest.raises(TF, match="exceeded the timeout limit"):
+            chain.has_equal_value(expr_code="f()")
+        stu_process = chain._state.student_process
+        assert stu_process.limit_exceeded.limit == "timeout"
+        pool.checkin(stu_process)
+        assert not stu_process.is_alive()
+
+
+@pytest.mark.parametrize("mode", ["simple", "stub"])
+def test_execute_tasks(mode):
+    process, _, _ = run_single_process("", "x = 1", mode=mode)
+    answers = process.executeTasks(
+        [TaskCaptureOutput("print(x)"), TaskCaptureOutput("print(x + 1)")]
+    )
+    assert answers == [("1\n", None), ("2\n", None)]
+    if mode != "stub":
+        process.kill()
+
+
+def test_task_collector():
+    code = "import pandas as pd\ndf = pd.DataFrame({'a': [1]})\nx = [1]"
+    process, _, _ = run_single_process("", code)
+    with TaskCollector(process) as collector:
+        defined = isDefinedInProcess.defer(collector, "x")
+        undefined = isDefinedInProcess.defer(collector, name="y")
+        columns = getColumnsInProcess.defer(collector, "df")
+        failed = getColumnsInProcess.defer(collector, "x")
+        with pytest.raises(ValueError):
+            defined.get()
+    assert defined.get() is True
+    assert undefined.get() is False
+    assert columns.get() == ["a"]
+    assert "backend-error" in str(failed.get())
+    process.kill()
+
+
+def test_channel_strips_ast():
+    import ast
+    from multiprocessing import Pipe
+    from pythonwhat.State import Dispatcher
+
+    _, tree = Dispatcher().parse("x = [i * 2 for i in range(3)]\nprint(x)")
+    assert hasattr(tree.body[0], "first_token")
+    sender, receiver = Pipe()
+    Channel(sender).send({"tree": tree.body[0]})
+    node = Channel(receiver).recv()["tree"]
+    assert not hasattr(node, "first_token")
+    assert not hasattr(node.value, "last_token")
+    assert ast.dump(node, include_attributes=True) == ast.dump(
+        tree.body[0], include_attributes=True
+    )
+
+
+def test_channel_keeps_references():
+    from multiprocessing import Pipe
+
+    cyclic = [1]
+    cyclic.append(cyclic)
+    shared = [2]
+    sender, receiver = Pipe()
+    Channel(sender).send({"cyclic": cyclic, "a": shared, "b": shared})
+    answer = Channel(receiver).recv()
+    assert answer["cyclic"][1] is answer["cyclic"]
+    assert answer["a"] is answer["b"]
+
+
+def test_dispatch_overlaps_processes():
+    from pythonwhat.tasks import dispatch
+
+    names = ["sol", "stu"]
+    with in_temp_dir():
+        sol_process, _, _ = run_single_process("", "")
+        stu_process, _, _ = run_single_process("", "")
+        sol_task, stu_task = [
+            TaskCaptureOutput(record_interval(name, names)) for name in names
+        ]
+        answers = dispatch(
+            lambda: sol_process.executeTask(sol_task),
+            lambda: stu_process.executeTask(stu_task),
+            sol_process,
+            stu_process,
+        )
+        assert intervals_overlap(names)
+    assert answers == (("", None), ("", None))
+
+    def fail():
+        raise ValueError("solution")
+
+    print_task = TaskCaptureOutput("print(1)")
+    with pytest.raises(ValueError, match="solution"):
+        dispatch(
+            fail, lambda: stu_process.executeTask(print_task), sol_process, stu_process
+        )
+    sol_process.kill()
+    stu_process.kill()
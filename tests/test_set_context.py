@@ -67,3 +67,19 @@ def test_fail():
     }
     output = helper.run(data)
     assert not output["correct"]
+
+
+def test_set_context_compiles_once():
+    from pythonwhat.tasks import getCodeCacheInfoInProcess
+    from pythonwhat.test_exercise import setup_state
+
+    code = "for i in range(3):\n    x = i * 2"
+    state = setup_state(code, code)
+    body = state.check_for_loop().check_body()
+    before = getCodeCacheInfoInProcess(process=state._state.student_process)
+    for i in range(4):
+        body.set_context(i).has_equal_value(name="x")
+    after = getCodeCacheInfoInProcess(process=state._state.student_process)
+    # the body and name are compiled on the first evaluation only
+    assert after["misses"] - before["misses"] <= 2
+    assert after["hits"] - before["hits"] >= 6
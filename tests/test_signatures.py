@@ -156,3 +156,27 @@ def test_center():
     fun_state = s.check_function("x.center")
     fun_state.check_args("width").has_equal_value()
     fun_state.check_args("fillchar").has_equal_value()
+
+
+def test_signatures_cached_per_grading():
+    code = "round(1.23, 1)\nround(2.34, 1)\nx = [1]\nx.append(2)"
+    chain = setup_state(code, code)
+    chain.check_function("round", index=0).check_args("ndigits")
+    chain.check_function("round", index=1).check_args("ndigits")
+    chain.check_function("x.append").check_args("object")
+    cache = chain._state.signature_cache
+    assert len(cache) == 4
+    assert {process for process, *_ in cache} == {
+        chain._state.student_process,
+        chain._state.solution_process,
+    }
+
+
+def test_custom_manual_sigs():
+    from inspect import Parameter as param
+
+    chain = setup_state("round(1.23, 1)", "round(1.23, 1)")
+    chain._state.manual_sigs = {"round": [param("num", param.POSITIONAL_OR_KEYWORD)]}
+    with pytest.raises(Exception):
+        chain.check_function("round").check_args("ndigits")
+    assert chain._state.signature_cache == {}
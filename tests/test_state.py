@@ -1,6 +1,9 @@
+import gc
+
 import pytest
 from protowhat.Reporter import Reporter
-from pythonwhat.State import State
+from pythonwhat.State import ContextCache, Dispatcher, SolutionParseCache, State
+from pythonwhat.parsing import FunctionParser
 from protowhat.failure import InstructorError
 
 
@@ -15,3 +18,120 @@ def test_pec_parsing_error():
             reporter=Reporter(),
             raw_student_output=None,
         )
+
+
+def test_context_cache():
+    cache = ContextCache(max_size=2)
+    parsed = []
+
+    def compute(code):
+        parsed.append(code)
+        return Dispatcher().get_context_mappings(code)
+
+    pecs = ["import numpy as np", "import pandas as pd", "from math import pi"]
+    assert cache.get_mappings(pecs[0], compute) == {"np": "numpy"}
+    assert cache.get_mappings(pecs[0], compute) == {"np": "numpy"}
+    cache.get_mappings(pecs[1], compute)
+    cache.get_mappings(pecs[0], compute)
+    cache.get_mappings(pecs[2], compute)
+    assert len(cache) == 2
+    cache.get_mappings(pecs[0], compute)
+    cache.get_mappings(pecs[1], compute)
+    assert parsed == [pecs[0], pecs[1], pecs[2], pecs[1]]
+
+    cache = ContextCache(max_memory=1)
+    cache.get_mappings(pecs[0], compute)
+    assert len(cache) == 0
+
+
+def test_dispatcher_parses_pec_once(monkeypatch):
+    monkeypatch.setattr(Dispatcher, "_context_cache", ContextCache())
+    parsed = []
+    get_context_mappings = Dispatcher.get_context_mappings
+
+    def counting(self, code):
+        parsed.append(code)
+        return get_context_mappings(self, code)
+
+    monkeypatch.setattr(Dispatcher, "get_context_mappings", counting)
+    for _ in range(3):
+        assert Dispatcher("import numpy as np").context_mappings == {"np": "numpy"}
+    assert parsed == ["import numpy as np"]
+
+
+def test_dispatcher_shared_by_children(monkeypatch):
+    state = State(
+        student_code="round(1.5)",
+        solution_code="round(1.5)",
+        pre_exercise_code="",
+        student_process=None,
+        solution_process=None,
+        reporter=Reporter(),
+        raw_student_output=None,
+    )
+    parsers = []
+    init = FunctionParser.__init__
+    monkeypatch.setattr(
+        FunctionParser, "__init__", lambda self: parsers.append(self) or init(self)
+    )
+    node = state.student_ast.body[0]
+    for _ in range(2):
+        child = state.to_child(student_ast=node, solution_ast=node)
+        assert child.ast_dispatcher is state.ast_dispatcher
+        child.ast_dispatcher.find("function_calls", child.student_ast)
+    assert len(parsers) == 1
+
+
+def test_dispatcher_drops_outputs_of_freed_nodes():
+    dispatcher = Dispatcher()
+    tokens, tree = dispatcher.parse("round(1.5)")
+    assert "round" in dispatcher.find("function_calls", tree)
+    assert len(dispatcher._parser_cache) == 1
+    del tokens, tree
+    gc.collect()
+    assert len(dispatcher._parser_cache) == 0
+
+
+def make_state(solution_code, pre_exercise_code=""):
+    return State(
+        student_code=solution_code,
+        solution_code=solution_code,
+        pre_exercise_code=pre_exercise_code,
+        student_process=None,
+        solution_process=None,
+        reporter=Reporter(),
+        raw_student_output=None,
+    )
+
+
+def test_solution_parse_cache(monkeypatch):
+    monkeypatch.setattr(Dispatcher, "solution_cache", SolutionParseCache(max_size=2))
+    cache = Dispatcher.solution_cache
+    state = make_state("round(1.5)")
+    calls = state.ast_dispatcher.find("function_calls", state.solution_ast)
+
+    other = make_state("round(1.5)")
+    assert other.solution_ast is state.solution_ast
+    assert other.solution_ast_tokens is state.solution_ast_tokens
+    assert other.student_ast is not state.student_ast
+    assert other.ast_dispatcher.find("function_calls", other.solution_ast) is calls
+    child = other.to_child(
+        student_ast=other.student_ast.body[0], solution_ast=other.solution_ast.body[0]
+    )
+    node = child.solution_ast
+    assert child.ast_dispatcher.find("function_calls", node) is state.ast_dispatcher.find(
+        "function_calls", node
+    )
+
+    # the pre exercise code is part of the key
+    assert make_state("round(1.5)", "x = 1").solution_ast is not state.solution_ast
+    assert len(cache) == 2
+    make_state("round(2.5)")
+    assert len(cache) == 2
+    assert make_state("round(1.5)").solution_ast is not state.solution_ast
+
+    tree = make_state("round(2.5)").solution_ast
+    cache.invalidate("round(2.5)")
+    assert make_state("round(2.5)").solution_ast is not tree
+    cache.clear()
+    assert len(cache) == 0
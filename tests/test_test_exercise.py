@@ -1,7 +1,23 @@
+import os
 import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 import tests.helper as helper
+from protowhat.failure import InstructorError
+from tests.helper import record_interval, intervals_overlap
+from pythonwhat.local import (
+    ExerciseBundle,
+    ResultCache,
+    SolutionCache,
+    run_exercise,
+    run_exercise_async,
+    run_single_process,
+)
+from pythonwhat.test_exercise import compile_exercise
+from pythonwhat.test_exercise import test_exercise_batch as grade_batch
+from pythonwhat.test_exercise import test_exercise_async as grade_async
 
 
 @pytest.fixture(scope="session", autouse=True)
@@ -84,3 +100,272 @@ def test_enrichment_error():
     output = helper.run(data)
     assert not output["correct"]
     # assert not "line_start" in output
+
+
+def test_solution_cache():
+    cache = SolutionCache()
+    with helper.in_temp_dir():
+        for code, correct in [("x = 4", True), ("x = 5", False), ("x = 4", True)]:
+            _, stu_process, raw_stu_output, error = run_exercise("", "", code)
+            output = helper.test_exercise(
+                sct="Ex().check_object('x').has_equal_value()",
+                student_code=code,
+                solution_code="x = 4",
+                pre_exercise_code="",
+                student_process=stu_process,
+                solution_process=None,
+                raw_student_output=raw_stu_output,
+                ex_type="NormalExercise",
+                error=error,
+                solution_cache=cache,
+            )
+            assert output["correct"] == correct
+            assert len(cache) == 1
+    cache.clear()
+
+
+@pytest.mark.parametrize("directory", [False, True])
+def test_result_cache(directory, tmp_path):
+    sct = """
+Ex().check_object('x').has_equal_value()
+Ex().has_printout(0)
+Ex().check_function('round').check_args(0).has_equal_value()
+"""
+    solution = "x = [1, 2]\nprint(x)\nround(2.5)"
+    cache = ResultCache(directory=str(tmp_path) if directory else None)
+    with helper.in_temp_dir():
+        for code, correct in [(solution, True), (solution, True), ("x = [1]", False)]:
+            sol_process, stu_process, raw_stu_output, error = run_exercise(
+                "", solution, code
+            )
+            tasks = []
+            execute = sol_process.executeTask
+            sol_process.executeTask = lambda task: tasks.append(task) or execute(task)
+            output = helper.test_exercise(
+                sct=sct,
+                student_code=code,
+                solution_code=solution,
+                pre_exercise_code="",
+                student_process=stu_process,
+                solution_process=sol_process,
+                raw_student_output=raw_stu_output,
+                ex_type="NormalExercise",
+                error=error,
+                result_cache=cache,
+            )
+            del sol_process.executeTask
+            assert output["correct"] == correct
+            assert not tasks or not cache.hits
+            if directory:
+                cache.clear()
+    assert cache.hits > 0
+
+
+def test_compile_exercise(tmp_path):
+    sct = """
+Ex().check_object('x').has_equal_value()
+Ex().has_printout(0)
+Ex().check_function('round').check_args(0).has_equal_value()
+"""
+    solution = "x = [1, 2]\nprint(x)\nround(2.5)"
+    path = str(tmp_path / "bundle")
+    with helper.in_temp_dir():
+        output = compile_exercise(sct, solution, "", path)
+        assert output["correct"]
+        bundle = ExerciseBundle(path)
+        assert bundle.parser_outputs
+
+        def grade(code, sct=sct, solution=solution):
+            stu_process, raw_stu_output, error = run_single_process("", code)
+            return helper.test_exercise(
+                sct=sct,
+                student_code=code,
+                solution_code=solution,
+                pre_exercise_code="",
+                student_process=stu_process,
+                solution_process=None,
+                raw_student_output=raw_stu_output,
+                ex_type="NormalExercise",
+                error=error,
+                bundle=bundle,
+            )
+
+        for code, correct in [
+            (solution, True),
+            ("x = [1]\nprint(x)\nround(2.5)", False),
+            ("x = [1, 2]\nprint([1, 2])\nround(3.5)", False),
+        ]:
+            assert grade(code)["correct"] == correct
+        assert bundle.misses == 0
+
+        # checks that weren't recorded use a solution process
+        output = grade(
+            "x = [3, 2]",
+            sct="Ex().check_object('x').has_equal_value(expr_code='x[1]')",
+        )
+        assert output["correct"]
+        assert bundle.misses == 1
+
+        with pytest.raises(ValueError):
+            grade(solution, solution="x = 1")
+
+
+def test_result_cache_after_run():
+    sct = """
+Ex().check_object('x')
+Ex().check_file('a.py', solution_code='y = 1').run().check_object('x')
+"""
+    with helper.in_temp_dir():
+        with open("a.py", "w") as f:
+            f.write("x = 1")
+        sol_process, stu_process, raw_stu_output, error = run_exercise(
+            "", "x = 1", "x = 1"
+        )
+        with pytest.raises(InstructorError):
+            helper.test_exercise(
+                sct=sct,
+                student_code="x = 1",
+                solution_code="x = 1",
+                pre_exercise_code="",
+                student_process=stu_process,
+                solution_process=sol_process,
+                raw_student_output=raw_stu_output,
+                ex_type="NormalExercise",
+                error=error,
+                result_cache=ResultCache(),
+            )
+
+
+def test_result_cache_solution_dir():
+    code = "x = open('data.txt').read()"
+    sct = "".join(
+        "Ex().check_file('a.py', solution_code={!r}).run(solution_dir={!r})"
+        ".has_equal_value(expr_code='x')\n".format(code, solution_dir)
+        for solution_dir in ["sol1", "sol2"]
+    )
+    with helper.in_temp_dir():
+        for path, content in [
+            ("a.py", code),
+            ("data.txt", "1"),
+            ("sol1/data.txt", "1"),
+            ("sol2/data.txt", "2"),
+        ]:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "w") as f:
+                f.write(content)
+        sol_process, stu_process, raw_stu_output, error = run_exercise("", "", "")
+        output = helper.test_exercise(
+            sct=sct,
+            student_code="",
+            solution_code="",
+            pre_exercise_code="",
+            student_process=stu_process,
+            solution_process=sol_process,
+            raw_student_output=raw_stu_output,
+            ex_type="NormalExercise",
+            error=error,
+            result_cache=ResultCache(),
+        )
+    assert not output["correct"]
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+@pytest.mark.parametrize("mode", ["simple", "stub"])
+def test_exercise_batch(ordered, mode):
+    submissions = ["x = 4", "x = 5", "x = ", "x = 4\nx.append(1)", "x = 4"]
+    with helper.in_temp_dir():
+        results = grade_batch(
+            sct="Ex().check_object('x').has_equal_value()",
+            solution_code="x = 4",
+            pre_exercise_code="",
+            submissions=submissions,
+            ordered=ordered,
+            mode=mode,
+        )
+        results = list(results)
+    indices = [index for index, _ in results]
+    if ordered:
+        assert indices == list(range(len(submissions)))
+    assert sorted(indices) == list(range(len(submissions)))
+    correct = [output["correct"] for _, output in sorted(results)]
+    assert correct == [True, False, False, False, True]
+
+
+@pytest.mark.parametrize("mode", ["simple", "stub"])
+def test_exercise_batch_isolates_solution(mode):
+    code = "x = [1]\ndef f():\n    x.append(2)\n    return len(x)"
+    with helper.in_temp_dir():
+        results = grade_batch(
+            sct="Ex().has_equal_value(expr_code='f()')",
+            solution_code=code,
+            pre_exercise_code="",
+            submissions=[code] * 3,
+            mode=mode,
+        )
+        correct = [output["correct"] for _, output in results]
+    assert correct == [True, True, True]
+
+
+def test_exercise_async():
+    cache = SolutionCache()
+
+    async def grade(code):
+        _, stu_process, raw_stu_output, error = await run_exercise_async(
+            "", "", code
+        )
+        return await grade_async(
+            sct="Ex().check_object('x').has_equal_value()",
+            student_code=code,
+            solution_code="x = 4",
+            pre_exercise_code="",
+            student_process=stu_process,
+            solution_process=None,
+            raw_student_output=raw_stu_output,
+            ex_type="NormalExercise",
+            error=error,
+            solution_cache=cache,
+        )
+
+    async def grade_all(submissions):
+        return await asyncio.gather(*map(grade, submissions))
+
+    with helper.in_temp_dir():
+        outputs = asyncio.run(grade_all(["x = 4", "x = 5", "x = 4", "x = "]))
+    assert [output["correct"] for output in outputs] == [True, False, True, False]
+    cache.clear()
+
+
+@pytest.mark.parametrize("workers", [None, 1])
+def test_exercise_async_runs_scts_in_parallel(workers):
+    names = ["first", "second"]
+    executor = ThreadPoolExecutor(max_workers=workers) if workers else None
+    # a single thread runs the SCTs in turn, so the first one waits in vain
+    timeout = 1 if workers == 1 else 10
+
+    async def grade(name, code):
+        sol_process, stu_process, raw_stu_output, error = await run_exercise_async(
+            "", "x = 4", code
+        )
+        return await grade_async(
+            sct=record_interval(name, names, timeout)
+            + "Ex().check_object('x').has_equal_value()",
+            student_code=code,
+            solution_code="x = 4",
+            pre_exercise_code="",
+            student_process=stu_process,
+            solution_process=sol_process,
+            raw_student_output=raw_stu_output,
+            ex_type="NormalExercise",
+            error=error,
+            executor=executor,
+        )
+
+    async def grade_all():
+        return await asyncio.gather(grade("first", "x = 4"), grade("second", "x = 5"))
+
+    with helper.in_temp_dir():
+        outputs = asyncio.run(grade_all())
+        assert intervals_overlap(names) == (workers is None)
+    if executor is not None:
+        executor.shutdown()
+    assert [output["correct"] for output in outputs] == [True, False]
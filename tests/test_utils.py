@@ -0,0 +1,32 @@
+import pytest
+from pythonwhat import utils
+
+
+@pytest.mark.parametrize(
+    "code, names",
+    [
+        ("a + b", {"a", "b"}),
+        ("a.append(x)", {"a", "append", "x"}),
+        ("[x * c for x in a]", {"a", "c"}),
+        ("def f():\n    return a", {"f", "a"}),
+        ("globals()['a']", None),
+        ("(lambda: vars())()", None),
+        ("exec('a = 1')", None),
+    ],
+)
+def test_get_used_names(code, names):
+    assert utils.get_used_names(code) == (None if names is None else frozenset(names))
+
+
+def test_get_used_names_code_object():
+    code = compile("a[0]", "<script>", "eval")
+    assert utils.get_used_names(code) == {"a"}
+
+
+def test_copy_env_names():
+    env = {"a": [1], "b": [2], "c": 3}
+    copied = utils.copy_env(env, {"a", "c", "d"})
+    assert copied == env
+    assert copied["a"] is not env["a"]
+    assert copied["b"] is env["b"]
+    assert utils.copy_env(env)["b"] is not env["b"]